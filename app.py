@@ -1,11 +1,12 @@
 from flask import Flask, request, jsonify
 import requests
-from io import BytesIO
-from PIL import Image
-import PIL
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
 import vertexai.preview.generative_models as generative_models
+from deadline import Deadline, DeadlineExceeded
+import categorize
+import partial_fetch
+import preprocess_pool
 
 app = Flask(__name__)
 
@@ -36,24 +37,22 @@ generation_config = {
 }
 
 # Initialize the model
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
+model = categorize.regional_model(system_instruction)
 
-def fetch_and_preprocess_image(image_url):
+def fetch_and_preprocess_image(image_url, deadline=None):
     """Fetches the image from the URL, converts it to a format suitable for the model, and returns a Part object."""
-    response = requests.get(image_url)
-    image = Image.open(BytesIO(response.content))
-    image = image.resize((224, 224), PIL.Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
+    deadline = deadline or Deadline()
+    source = partial_fetch.fetch_image(image_url, deadline)
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
 
-def predict_categories(caption, image_url):
+def predict_categories(caption, image_url, deadline=None):
     """Combines caption and image into parts, calls the model, and returns the predicted categories."""
+    deadline = deadline or Deadline()
     caption_part = Part.from_text(caption)
-    image_part = fetch_and_preprocess_image(image_url)
+    image_part = fetch_and_preprocess_image(image_url, deadline)
     contents = [caption_part, image_part]
-    response = model.generate_content(contents, generation_config=generation_config)
+    response = deadline.call(model.generate_content, contents, generation_config=generation_config)
     return response.text.strip()  # Remove leading/trailing whitespace
 
 @app.route('/predict', methods=['POST'])
@@ -65,9 +64,12 @@ def predict():
     caption = data['caption']
     image_url = data['image_url']
 
+    deadline = Deadline.from_request(request)
     try:
-        predicted_categories = predict_categories(caption, image_url)
+        predicted_categories = predict_categories(caption, image_url, deadline)
         return jsonify({"categories": predicted_categories.split(",")})
+    except (DeadlineExceeded, requests.Timeout) as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,113 @@
+"""Compares full and Range-based partial image downloads against a local HTTP server.
+
+Usage: python bench_partial_fetch.py [image_dir] [--bandwidth-mbps N] [--repeat N]
+Without an image_dir a few synthetic 12MP progressive JPEGs are generated.
+"""
+import argparse
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat
+
+import bench_preprocess
+import media_fetch
+import partial_fetch
+import preprocess
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler with single-range support and an optional bandwidth cap (http.server has neither)."""
+
+    protocol_version = "HTTP/1.1"
+    bandwidth = None
+    bytes_sent = 0
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as file:
+            data = file.read()
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for offset in range(0, len(body), 64 * 1024):
+            chunk = body[offset:offset + 64 * 1024]
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            self.wfile.write(chunk)
+        with self._lock:
+            RangeRequestHandler.bytes_sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def difference(a, b):
+    """Mean absolute per-channel difference between two preprocessed JPEGs, 0-255."""
+    a, b = (Image.open(BytesIO(data)).convert("RGB") for data in (a, b))
+    return sum(ImageStat.Stat(ImageChops.difference(a, b)).mean) / 3
+
+
+def run(paths, base_url, repeat, use_partial):
+    partial_fetch.PARTIAL_FETCH = use_partial
+    RangeRequestHandler.bytes_sent = 0
+    outputs = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            data = partial_fetch.fetch_image(f"{base_url}/{os.path.basename(path)}")
+            outputs[path] = preprocess.preprocess_image(data)[1]
+    images = len(paths) * repeat
+    return outputs, 1000 * (time.perf_counter() - start) / images, RangeRequestHandler.bytes_sent / images / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image_dir", nargs="?")
+    parser.add_argument("--bandwidth-mbps", type=float, default=100.0, help="0 for unthrottled")
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.image_dir:
+            directory, paths = args.image_dir, bench_preprocess.load_corpus(args.image_dir)
+        else:
+            directory, paths = scratch, bench_preprocess.synthetic_corpus(scratch, progressive=True)
+        RangeRequestHandler.bandwidth = args.bandwidth_mbps * 1e6 / 8 or None
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeRequestHandler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        # Warm up the keep-alive connection so neither mode pays for the handshake
+        media_fetch.fetch_range(f"{base_url}/{os.path.basename(paths[0])}", 0, 1)
+
+        rate = f"{args.bandwidth_mbps:g} Mbit/s" if args.bandwidth_mbps else "unthrottled"
+        print(f"{len(paths)} images x {args.repeat} runs, {rate}")
+        print(f"{'mode':<8} {'ms/img':>8} {'KB/img':>9} {'mean diff':>10}")
+        full, full_ms, full_kb = run(paths, base_url, args.repeat, use_partial=False)
+        print(f"{'full':<8} {full_ms:>8.1f} {full_kb:>9.1f} {0.0:>10.2f}")
+        partial_outputs, partial_ms, partial_kb = run(paths, base_url, args.repeat, use_partial=True)
+        diff = sum(difference(full[path], partial_outputs[path]) for path in paths) / len(paths)
+        print(f"{'partial':<8} {partial_ms:>8.1f} {partial_kb:>9.1f} {diff:>10.2f}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Compares image preprocessing paths on CPU time, allocations and peak memory.
+
+Usage: python bench_preprocess.py [image_dir] [--repeat N]
+Without an image_dir a few synthetic 12MP photos are generated.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image
+
+import preprocess
+
+
+def baseline(data):
+    # What every service did before preprocess.py: full-resolution decode, then LANCZOS
+    image = Image.open(BytesIO(data))
+    image = image.resize(preprocess.TARGET_SIZE, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def pil(data):
+    return preprocess.preprocess_image(data, backend="pil")[1]
+
+
+def opencv(data):
+    return preprocess.preprocess_image(data, backend="opencv")[1]
+
+
+METHODS = {"baseline": baseline, "pil": pil, "opencv": opencv}
+
+
+def synthetic_corpus(directory, count=4, size=(4000, 3000), progressive=False):
+    """Writes count noisy gradient JPEGs so the encoder can't compress them to nothing."""
+    paths = []
+    for index in range(count):
+        image = Image.linear_gradient("L").resize(size).convert("RGB")
+        noise = Image.effect_noise(size, 40 + index * 10).convert("RGB")
+        image = Image.blend(image, noise, 0.3)
+        path = os.path.join(directory, f"synthetic_{index}.jpg")
+        image.save(path, format="JPEG", quality=90, progressive=progressive)
+        paths.append(path)
+    return paths
+
+
+def load_corpus(directory):
+    extensions = (".jpg", ".jpeg", ".png", ".webp")
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(extensions))
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_method(name, paths, repeat):
+    """Runs one method over the corpus in this process and returns its stats."""
+    blobs = [open(path, "rb").read() for path in paths]
+    function = METHODS[name]
+    rss_before = peak_rss_kb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    output_bytes = 0
+    for _ in range(repeat):
+        for data in blobs:
+            output_bytes += len(function(data))
+    images = len(blobs) * repeat
+    cpu_ms = 1000 * (time.process_time() - cpu_start) / images
+    wall_ms = 1000 * (time.perf_counter() - wall_start) / images
+    # A separate pass, since tracing slows everything down. It sees Python-level buffers (payload
+    # copies, NumPy arrays) but not Pillow's own pixel storage, which only shows up in peak RSS.
+    tracemalloc.start()
+    for data in blobs:
+        function(data)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "method": name,
+        "images": images,
+        "cpu_ms_per_image": cpu_ms,
+        "wall_ms_per_image": wall_ms,
+        "peak_rss_growth_mb": (peak_rss_kb() - rss_before) / 1024,
+        "traced_peak_mb": traced_peak / 1024 / 1024,
+        "output_kb_per_image": output_bytes / images / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image_dir", nargs="?")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--method", help=argparse.SUPPRESS)
+    parser.add_argument("--generate", help=argparse.SUPPRESS)
+    parser.add_argument("--paths", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.generate:
+        print(json.dumps(synthetic_corpus(args.generate)))
+        return
+    if args.method:
+        # Child mode: one method per process so peak RSS isn't shared between them
+        print(json.dumps(run_method(args.method, args.paths, args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.image_dir:
+            paths = load_corpus(args.image_dir)
+        else:
+            # Generated in a child too: Linux carries ru_maxrss across fork/exec, so a big parent would mask the children
+            paths = json.loads(subprocess.run([sys.executable, __file__, "--generate", scratch],
+                                              check=True, capture_output=True, text=True).stdout)
+        if not paths:
+            sys.exit(f"No images found in {args.image_dir}")
+        print(f"{len(paths)} images x {args.repeat} runs")
+        print(f"{'method':<10} {'cpu ms/img':>11} {'wall ms/img':>12} {'peak rss MB':>12} {'traced MB':>10} "
+              f"{'out KB/img':>11}")
+        for name in METHODS:
+            output = subprocess.run(
+                [sys.executable, __file__, "--method", name, "--repeat", str(args.repeat), "--paths", *paths],
+                check=True, capture_output=True, text=True).stdout
+            stats = json.loads(output)
+            print(f"{name:<10} {stats['cpu_ms_per_image']:>11.1f} {stats['wall_ms_per_image']:>12.1f} "
+                  f"{stats['peak_rss_growth_mb']:>12.1f} {stats['traced_peak_mb']:>10.2f} {stats['output_kb_per_image']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
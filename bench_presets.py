@@ -0,0 +1,156 @@
+"""Compares the preprocessing presets on throughput, payload size and fidelity to the original pipeline.
+
+Usage: python bench_presets.py [corpus_dir] [--repeat N] [--caption TEXT] [--categorize]
+The corpus may hold images and videos; without one, synthetic 12MP photos and 1080p frames are used.
+The reference is the services' original preprocessing: a full decode, a plain LANCZOS resize and
+PIL's default JPEG encode. --categorize also sends every output to the model with the caption, as
+the services do (needs Vertex AI credentials), and reports how often each preset's categories agree
+with the original pipeline's.
+"""
+import argparse
+import os
+import tempfile
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageChops, ImageStat
+
+import bench_preprocess
+import model_routing
+import preprocess
+
+REFERENCE = "baseline"
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+FRAMES_PER_VIDEO = 5
+
+
+def load_frames(directory):
+    """Samples up to FRAMES_PER_VIDEO BGR frames from each video in directory, the way the original services did."""
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(VIDEO_EXTENSIONS):
+            continue
+        cap = cv2.VideoCapture(os.path.join(directory, name))
+        success, frame = cap.read()
+        interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / FRAMES_PER_VIDEO)
+        count = 0
+        while success and count < FRAMES_PER_VIDEO:
+            frames.append(frame)
+            count += 1
+            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + interval)
+            success, frame = cap.read()
+        cap.release()
+    return frames
+
+
+def synthetic_frames(count=10, size=(1080, 1920)):
+    rows = np.linspace(0, 255, size[0], dtype=np.float32)[:, None, None]
+    noise = np.random.default_rng(0).normal(0, 30, (count, *size, 3)).astype(np.float32)
+    return list(np.clip(rows + noise, 0, 255).astype(np.uint8))
+
+
+def baseline_image(data):
+    """The original services' image path: full decode, plain LANCZOS resize, PIL's default JPEG quality."""
+    image = Image.open(BytesIO(data))
+    if image.mode not in ("RGB", "L"):
+        # The original would have failed to save these as JPEG; convert so the corpus still runs
+        image = image.convert("RGB")
+    image = image.resize(preprocess.TARGET_SIZE, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG")
+    return "image/jpeg", buffer.getvalue()
+
+
+def baseline_frame(frame):
+    """The original services' frame path: BGR to RGB on the full frame, then as baseline_image."""
+    image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).resize(preprocess.TARGET_SIZE, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def pipelines():
+    """(image function, frame function) for the original pipeline and for each preset, by name."""
+    result = {REFERENCE: (baseline_image, baseline_frame)}
+    for name in preprocess.PRESETS:
+        result[name] = (lambda data, name=name: preprocess.preprocess_image(data, preset=name),
+                        lambda frame, name=name: preprocess.preprocess_frame(frame, preset=name))
+    return result
+
+
+def difference(a, b):
+    """Mean absolute per-channel difference between two encoded images, 0-255."""
+    a, b = (Image.open(BytesIO(data)).convert("RGB") for data in (a, b))
+    if a.size != b.size:
+        return 0.0
+    return sum(ImageStat.Stat(ImageChops.difference(a, b)).mean) / 3
+
+
+def run_pipeline(image_function, frame_function, images, frames, repeat):
+    """Preprocesses everything repeat times; returns the outputs and per-item timings."""
+    outputs, stats = [], {}
+    for kind, items, function in (("image", images, image_function),
+                                  ("frame", frames, lambda frame: ("image/jpeg", frame_function(frame)))):
+        if not items:
+            continue
+        start = time.process_time()
+        for _ in range(repeat):
+            results = [function(item) for item in items]
+        elapsed = time.process_time() - start
+        stats[kind] = {"per_second": len(items) * repeat / elapsed if elapsed else float("inf"),
+                       "kb": sum(len(data) for _, data in results) / len(results) / 1024}
+        outputs.extend((kind, mime_type, data) for mime_type, data in results)
+    return outputs, stats
+
+
+def categorize(caption, outputs):
+    """Asks the model for each output's categories, sent after the caption as the services do for one media part."""
+    from vertexai.generative_models import Part
+
+    import demo_flask
+    from deadline import Deadline
+
+    tasks = {"image": model_routing.IMAGE, "frame": model_routing.VIDEO_FRAME}
+    return [demo_flask.generate_categories([Part.from_text(caption), Part.from_data(mime_type=mime_type, data=data)],
+                                           Deadline(), task=tasks[kind], caption=caption)
+            for kind, mime_type, data in outputs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus_dir", nargs="?")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--caption", default="Photos from the weekend")
+    parser.add_argument("--categorize", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.corpus_dir:
+            paths, frames = bench_preprocess.load_corpus(args.corpus_dir), load_frames(args.corpus_dir)
+        else:
+            paths, frames = bench_preprocess.synthetic_corpus(scratch), synthetic_frames()
+        images = [open(path, "rb").read() for path in paths]
+    print(f"{len(images)} images, {len(frames)} video frames, {args.repeat} runs")
+
+    results = {name: run_pipeline(*functions, images, frames, args.repeat) for name, functions in pipelines().items()}
+    reference = results[REFERENCE][0]
+    reference_categories = categorize(args.caption, reference) if args.categorize else None
+
+    header = f"{'preset':<10} {'img/s':>8} {'img KB':>7} {'frame/s':>8} {'frame KB':>9} {'pixel diff':>11}"
+    print(header + (f" {'agreement':>10}" if args.categorize else ""))
+    for name, (outputs, stats) in results.items():
+        image, frame = stats.get("image", {}), stats.get("frame", {})
+        diff = sum(difference(a[2], b[2]) for a, b in zip(reference, outputs)) / len(outputs)
+        line = (f"{name:<10} {image.get('per_second', 0):>8.1f} {image.get('kb', 0):>7.1f} "
+                f"{frame.get('per_second', 0):>8.1f} {frame.get('kb', 0):>9.1f} {diff:>11.2f}")
+        if args.categorize:
+            categories = reference_categories if name == REFERENCE else categorize(args.caption, outputs)
+            agreement = sum(map(model_routing.agreement, reference_categories, categories)) / len(categories)
+            line += f" {agreement:>10.3f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
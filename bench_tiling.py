@@ -0,0 +1,99 @@
+"""Compares per-image model calls with one labeled grid per post on tokens, payload, latency and agreement.
+
+Usage: python bench_tiling.py [corpus_dir] [--per-post N] [--categorize]
+Images are grouped into posts of N; without a corpus, synthetic 12MP photos are used. Token counts are
+estimates (a fixed cost per image part plus the system instruction, caption and grid note every call
+repeats) unless --categorize is given, which also calls
+the model for every post (needs Vertex AI credentials) to measure latency, count tokens and report
+how closely the grid's categories match the union of the per-image ones.
+"""
+import argparse
+import tempfile
+import time
+
+import bench_preprocess
+import model_routing
+import preprocess
+import tiling
+
+# Gemini 1.5 bills every image part the same, whatever its resolution
+IMAGE_PART_TOKENS = 258
+# Rough English average, for the text sent with each call
+CHARS_PER_TOKEN = 4
+
+
+def build_inputs(thumbnails, tiled):
+    """The (text, JPEG bytes) inputs for one post's model calls, and the CPU seconds spent tiling."""
+    if not tiled:
+        return [("", data) for data in thumbnails], 0.0
+    start = time.process_time()
+    grids = tiling.tile(thumbnails)
+    return [(tiling.describe(count), grid) for grid, count in grids], time.process_time() - start
+
+
+def estimated_tokens(inputs, caption, system_instruction):
+    """Tokens one post's calls send; every call repeats the system instruction and the caption."""
+    prompt_chars = len(system_instruction) + len(caption)
+    return sum(IMAGE_PART_TOKENS + (prompt_chars + len(text)) // CHARS_PER_TOKEN for text, _ in inputs)
+
+
+def categorize(caption, inputs):
+    """Makes the post's image calls the way demo_flask does; returns (categories, seconds, counted tokens)."""
+    from vertexai.generative_models import GenerativeModel, Part
+
+    import demo_flask
+    from deadline import Deadline
+
+    categories, seconds, tokens = set(), 0.0, 0
+    counter = GenerativeModel(model_routing.TIERS[model_routing.FAST]["model_name"],
+                              system_instruction=[demo_flask.system_instruction])
+    for text, data in inputs:
+        parts = [Part.from_text(caption)] + ([Part.from_text(text)] if text else [])
+        parts.append(Part.from_data(mime_type="image/jpeg", data=data))
+        start = time.perf_counter()
+        categories.update(demo_flask.generate_categories(parts, Deadline(), task=model_routing.IMAGE, caption=caption))
+        seconds += time.perf_counter() - start
+        tokens += counter.count_tokens(parts).total_tokens
+    return categories, seconds, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus_dir", nargs="?")
+    parser.add_argument("--per-post", type=int, default=4)
+    parser.add_argument("--caption", default="Photos from the weekend")
+    parser.add_argument("--categorize", action="store_true")
+    args = parser.parse_args()
+    # The prompt every call sends; importing the service needs no credentials
+    from demo_flask import system_instruction
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.corpus_dir:
+            paths = bench_preprocess.load_corpus(args.corpus_dir)
+        else:
+            paths = bench_preprocess.synthetic_corpus(scratch, count=2 * args.per_post)
+        thumbnails = [preprocess.preprocess_image(path)[1] for path in paths]
+    posts = [thumbnails[start:start + args.per_post] for start in range(0, len(thumbnails), args.per_post)]
+    print(f"{len(thumbnails)} images in {len(posts)} posts of up to {args.per_post}, grid {tiling.GRID_SIZE}px")
+
+    header = f"{'mode':<10} {'calls':>6} {'KB/post':>8} {'tokens/post':>12} {'tile ms':>8}"
+    print(header + (f" {'s/post':>7} {'counted':>8} {'agreement':>10}" if args.categorize else ""))
+    reference = None
+    for mode in ("per-image", "tiled"):
+        results = [build_inputs(post, mode == "tiled") for post in posts]
+        calls = sum(len(inputs) for inputs, _ in results) / len(posts)
+        kb = sum(len(data) for inputs, _ in results for _, data in inputs) / len(posts) / 1024
+        tokens = sum(estimated_tokens(inputs, args.caption, system_instruction) for inputs, _ in results) / len(posts)
+        tile_ms = 1000 * sum(seconds for _, seconds in results) / len(posts)
+        line = f"{mode:<10} {calls:>6.1f} {kb:>8.1f} {tokens:>12.0f} {tile_ms:>8.1f}"
+        if args.categorize:
+            answers = [categorize(args.caption, inputs) for inputs, _ in results]
+            reference = reference or [categories for categories, _, _ in answers]
+            agreement = sum(model_routing.agreement(a, b) for a, (b, _, _) in zip(reference, answers)) / len(posts)
+            line += (f" {sum(seconds for _, seconds, _ in answers) / len(posts):>7.2f}"
+                     f" {sum(counted for _, _, counted in answers) / len(posts):>8.0f} {agreement:>10.3f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import fnmatch
+import json
+import os
+import re
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import metrics
+
+# Optional JSON file of per-host rules, merged over the defaults below:
+#   {"cdn.example.com": {"drop": ["token", "exp"], "size_params": ["w", "h"],
+#                        "path": [["_\\d+x\\d+(?=\\.\\w+$)", ""]]},
+#    "img.example.net": {"keep": ["id"]}}
+# A rule applies to the host and its subdomains. "drop" and "size_params" name query parameters
+# (fnmatch patterns, case-insensitive) that don't change which asset is served; "keep" instead
+# lists the only ones that do. "path" holds regex substitutions that map size variants of a path
+# to one name. Only list size variants that are all at least the preprocessing target size, since
+# whichever variant is fetched first is what the caches hand out for the others.
+RULES_FILE = os.environ.get("URL_CANONICAL_RULES")
+
+# Tracking parameters and the signing parameters of S3, GCS and CloudFront presigned URLs: the
+# same object comes back whatever their values
+DEFAULT_DROP = ("utm_*", "fbclid", "gclid", "dclid", "msclkid", "igshid", "mc_cid", "mc_eid", "_ga",
+                "x-amz-*", "x-goog-*", "expires", "signature", "key-pair-id", "policy")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+Rule = namedtuple("Rule", ["drop", "keep", "path"])
+
+
+def make_rule(config):
+    drop = tuple(name.lower() for name in config.get("drop", []) + config.get("size_params", []))
+    keep = config.get("keep")
+    path = tuple((re.compile(pattern), replacement) for pattern, replacement in config.get("path", []))
+    return Rule(DEFAULT_DROP + drop, None if keep is None else {name.lower() for name in keep}, path)
+
+
+def load_rules(path=RULES_FILE):
+    if not path:
+        return {}
+    with open(path) as file:
+        return {host.lower().lstrip("."): make_rule(config) for host, config in json.load(file).items()}
+
+
+DEFAULT_RULE = make_rule({})
+rules = load_rules()
+
+
+def rule_for(host):
+    """The rule for host or the nearest parent domain that has one."""
+    labels = host.split(".")
+    for index in range(len(labels)):
+        rule = rules.get(".".join(labels[index:]))
+        if rule is not None:
+            return rule
+    return DEFAULT_RULE
+
+
+def _kept(name, rule):
+    name = name.lower()
+    if rule.keep is not None:
+        return name in rule.keep
+    return not any(fnmatch.fnmatchcase(name, pattern) for pattern in rule.drop)
+
+
+def canonicalize(url):
+    """The key for the asset behind an http(s) URL, shared by its CDN variants.
+
+    Lowercases the scheme and host, drops default ports and fragments, applies the host's rule and
+    sorts what's left of the query. Anything else (local paths, malformed URLs) is returned as it is.
+    This is an identity for caches and request dedupe only; fetches still go to the original URL.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+    host = parts.hostname.lower()
+    rule = rule_for(host)
+    netloc = f"[{host}]" if ":" in host else host
+    if port not in (None, DEFAULT_PORTS[scheme]):
+        netloc = f"{netloc}:{port}"
+    path = parts.path or "/"
+    for pattern, replacement in rule.path:
+        path = pattern.sub(replacement, path)
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if _kept(name, rule))
+    canonical = urlunsplit((scheme, netloc, path, urlencode(query), ""))
+    if canonical != url:
+        metrics.increment("url_canonicalized")
+    return canonical
@@ -0,0 +1,70 @@
+import os
+import threading
+
+import metrics
+import model_routing
+
+
+def _size(name, default):
+    side = int(os.environ.get(name, default))
+    return (side, side)
+
+
+# Opt-in: categorize each image from a small thumbnail first and only send a larger one when
+# that answer looks unreliable
+CASCADE = os.environ.get("IMAGE_CASCADE", "0") == "1"
+LOW_SIZE = _size("CASCADE_LOW_SIZE", "112")
+HIGH_SIZE = _size("CASCADE_HIGH_SIZE", "448")
+# A first-pass answer with more categories than this reads as guessing, and one with fewer than
+# MIN_CATEGORIES (a lone word) as the thumbnail being too small to tell; 1 turns that check off
+MAX_CATEGORIES = int(os.environ.get("CASCADE_MAX_CATEGORIES", "6"))
+MIN_CATEGORIES = int(os.environ.get("CASCADE_MIN_CATEGORIES", "2"))
+# Escalate when the first pass overlaps the caption's categories by no more than this (Jaccard);
+# -1 turns the caption check off
+MIN_CAPTION_AGREEMENT = float(os.environ.get("CASCADE_MIN_CAPTION_AGREEMENT", "0"))
+
+EMPTY, UNKNOWN, TOO_FEW, TOO_MANY, CAPTION_DISAGREEMENT = (
+    "empty", "unknown_categories", "too_few", "too_many", "caption_disagreement")
+
+_lock = threading.Lock()
+_first_passes = 0
+_escalations = 0
+
+
+def escalation_reason(categories, caption_categories=(), known_categories=()):
+    """Why a first-pass answer shouldn't be trusted, or None if it can stand."""
+    # An empty response splits into [""]
+    categories = [category.strip() for category in categories if category.strip()]
+    if not categories:
+        return EMPTY
+    known = {category.lower() for category in known_categories}
+    if known and not any(category.strip().lower() in known for category in categories):
+        return UNKNOWN
+    if len(categories) < MIN_CATEGORIES:
+        return TOO_FEW
+    if len(categories) > MAX_CATEGORIES:
+        return TOO_MANY
+    if caption_categories and model_routing.agreement(categories, caption_categories) <= MIN_CAPTION_AGREEMENT:
+        return CAPTION_DISAGREEMENT
+    return None
+
+
+def record(reason):
+    """Counts a first pass and, if reason is set, its escalation; keeps the escalation rate gauge current."""
+    global _first_passes, _escalations
+    with _lock:
+        _first_passes += 1
+        if reason is not None:
+            _escalations += 1
+        rate = _escalations / _first_passes
+    metrics.increment("cascade_first_passes")
+    if reason is not None:
+        metrics.increment("cascade_escalations")
+        metrics.increment(f"cascade_escalations_{reason}")
+    metrics.set_gauge("cascade_escalation_rate", rate)
+
+
+def escalation_rate():
+    """Share of first passes escalated so far, for estimating how many calls a post will take."""
+    with _lock:
+        return _escalations / _first_passes if _first_passes else 0.0
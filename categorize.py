@@ -0,0 +1,63 @@
+import cv2
+import requests
+from vertexai.generative_models import Part
+
+import preprocess_pool
+import vertex_pool
+from deadline import DeadlineExceeded
+
+MODEL_NAME = "gemini-1.5-flash-001"
+
+
+def regional_model(system_instruction, model_name=MODEL_NAME):
+    """A model whose calls are spread over the configured Vertex regions instead of pinned to one."""
+    return vertex_pool.pool.model(model_name, system_instruction)
+
+
+def extract_frames(video_file, deadline, max_frames=5, video_path=None):
+    """Samples up to max_frames evenly spaced frames from a video file as JPEG parts."""
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video file: {video_path or video_file}")
+
+    frames = []
+    success, frame = cap.read()
+    frame_interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / max_frames)
+
+    while success and len(frames) < max_frames:
+        deadline.raise_if_cancelled("frame extraction")
+        if deadline.expired():
+            # Keep the frames we already have rather than dropping the whole video
+            break
+        frames.append(Part.from_data(mime_type="image/jpeg", data=preprocess_pool.preprocess_frame(frame, deadline)))
+        cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + frame_interval)
+        success, frame = cap.read()
+
+    cap.release()
+    if not frames:
+        deadline.check("frame extraction")
+    return frames
+
+
+def generate_categories(model, contents, deadline, generation_config):
+    """Calls the model under the request deadline and splits its comma-separated answer."""
+    response = deadline.call(model.generate_content, contents, generation_config=generation_config)
+    return response.text.strip().split(", ")
+
+
+def collect(results, deadline, categories=()):
+    """Pools the categories from each model call in results; returns (categories, partial).
+
+    Running out of time after at least one answer ends the request early with partial set,
+    instead of failing it.
+    """
+    unique_categories = set(categories)
+    try:
+        for result in results:
+            unique_categories.update(result)
+    except (DeadlineExceeded, requests.Timeout):
+        if not unique_categories or not deadline.expired():
+            raise
+        # Out of time: answer with whatever the media processed so far gave us
+        return list(unique_categories), True
+    return list(unique_categories), False
@@ -0,0 +1,65 @@
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+
+import metrics
+
+# Each GenerativeModel opens its own gRPC channel, so this is also the channel count
+POOL_SIZE = int(os.environ.get("VERTEX_CLIENTS_PER_MODEL", "4"))
+
+# Every live pool, so a forked child can drop the channels it inherited from its parent
+_pools = weakref.WeakSet()
+
+
+class ClientPool:
+    """A fixed-size set of model clients handed out to the one with the fewest calls in flight."""
+
+    def __init__(self, factory, size=POOL_SIZE, name="model"):
+        self.factory = factory
+        self.size = max(1, size)
+        self.name = name
+        self._lock = threading.Lock()
+        self._reset()
+        _pools.add(self)
+
+    def _reset(self):
+        # Clients are built lazily, so a pool that is never used opens no channels
+        self._clients = [None] * self.size
+        self._outstanding = [0] * self.size
+        self._pid = os.getpid()
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            index = min(range(self.size), key=self._outstanding.__getitem__)
+            if self._clients[index] is None:
+                self._clients[index] = self.factory()
+            self._outstanding[index] += 1
+            client = self._clients[index]
+            pid = self._pid
+        try:
+            yield client
+        finally:
+            with self._lock:
+                # A fork during the call has already reset the counters
+                if pid == self._pid:
+                    self._outstanding[index] -= 1
+                outstanding = sum(self._outstanding)
+            metrics.set_gauge(f"client_pool_outstanding_{self.name}", outstanding)
+
+    def any_client(self):
+        """Returns a client that already exists, or None."""
+        with self._lock:
+            return next((client for client in self._clients if client is not None), None)
+
+
+def _reset_after_fork():
+    for pool in list(_pools):
+        pool._lock = threading.Lock()
+        pool._reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
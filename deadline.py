@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+
+# Time budget for a whole request, unless the client asks for less via the header
+DEFAULT_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "30"))
+MAX_TIMEOUT_SECONDS = float(os.environ.get("MAX_REQUEST_TIMEOUT_SECONDS", "120"))
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# Model calls have no timeout of their own, so they run on these threads and we stop waiting on them.
+# This is the floor; vertex_pool raises it to the total size of its client pools, so the threads are
+# never what caps model concurrency. A call that is given up on keeps its thread until the SDK returns.
+MODEL_CALL_WORKERS = int(os.environ.get("MODEL_CALL_WORKERS", "16"))
+# How often a waiting model call looks for cancellation
+CANCEL_POLL_SECONDS = 0.1
+
+_lock = threading.Lock()
+_workers = MODEL_CALL_WORKERS
+_reserved = 0
+_running = 0
+_executor = ThreadPoolExecutor(max_workers=_workers)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request has used up its time budget."""
+
+
+class RequestCancelled(Exception):
+    """Raised when the caller has gone away and the rest of the work should be dropped."""
+
+
+class WorkersSaturated(Exception):
+    """Raised instead of queueing a model call when every model call thread is busy."""
+
+
+def reserve_model_workers(count):
+    """Makes room for count more concurrent model calls, e.g. for a new pool of count model clients."""
+    global _executor, _reserved, _workers
+    with _lock:
+        _reserved += count
+        if _reserved <= _workers:
+            return
+        _workers = _reserved
+        # Calls already running finish on the old executor's threads
+        _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=_workers)
+    metrics.set_gauge("model_call_workers", _workers)
+
+
+def _tracked(fn, *args, **kwargs):
+    global _running
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        with _lock:
+            _running -= 1
+            running = _running
+        metrics.set_gauge("model_call_workers_busy", running)
+
+
+def _submit(fn, args, kwargs, stage):
+    global _running
+    with _lock:
+        if _running >= _workers:
+            running = None
+        else:
+            _running += 1
+            running = _running
+            future = _executor.submit(_tracked, fn, *args, **kwargs)
+    if running is None:
+        # Queueing would only spend the request's budget waiting behind calls that may never return
+        metrics.increment("model_call_workers_saturated")
+        raise WorkersSaturated(f"All {_workers} model call threads are busy; {stage} not started")
+    metrics.set_gauge("model_call_workers_busy", running)
+    return future
+
+
+class Deadline:
+    """Tracks the time left for one request and enforces it on each stage."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def from_request(cls, request):
+        """Builds a deadline from the X-Request-Timeout header (seconds), falling back to the default."""
+        value = request.headers.get(DEADLINE_HEADER)
+        try:
+            timeout = float(value) if value else DEFAULT_TIMEOUT_SECONDS
+        except ValueError:
+            timeout = DEFAULT_TIMEOUT_SECONDS
+        if timeout <= 0:
+            timeout = DEFAULT_TIMEOUT_SECONDS
+        return cls(min(timeout, MAX_TIMEOUT_SECONDS))
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def raise_if_cancelled(self, stage="request"):
+        if self._cancelled.is_set():
+            raise RequestCancelled(f"Request cancelled during {stage}")
+
+    def check(self, stage="request"):
+        """Raises if the request was cancelled or no time is left, otherwise returns the seconds remaining."""
+        self.raise_if_cancelled(stage)
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded during {stage}")
+        return remaining
+
+    def call(self, fn, *args, stage="model call", **kwargs):
+        """Runs fn in the background and gives up on it once the deadline passes or the request is cancelled."""
+        self.check(stage)
+        future = _submit(fn, args, kwargs, stage)
+        try:
+            return self.wait(future, stage)
+        except (DeadlineExceeded, RequestCancelled):
+            if not future.done():
+                # Still running, so it can't be stopped and holds its thread until it returns
+                metrics.increment("abandoned_calls")
+                metrics.add_gauge("abandoned_calls_running", 1)
+                future.add_done_callback(lambda _: metrics.add_gauge("abandoned_calls_running", -1))
+            raise
+
+    def wait(self, future, stage="background work"):
+        """Waits for a future's result, giving up on it once the deadline passes or the request is cancelled."""
+        while True:
+            try:
+                return future.result(timeout=min(self.remaining(), CANCEL_POLL_SECONDS))
+            except FutureTimeoutError:
+                if self.cancelled() or self.expired():
+                    future.cancel()
+                    self.check(stage)
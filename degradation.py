@@ -0,0 +1,74 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+# Level 0 is full quality. Level 1 samples fewer video frames, level 2 makes a single
+# combined model call per post, level 3 answers from the result cache or the caption only.
+NORMAL, FEWER_FRAMES, COMBINED_CALL, CAPTION_ONLY = 0, 1, 2, 3
+FRAME_BUDGETS = {NORMAL: 5, FEWER_FRAMES: 2, COMBINED_CALL: 2, CAPTION_ONLY: 0}
+
+
+def _thresholds(name, default):
+    return [float(value) for value in os.environ.get(name, default).split(",")]
+
+
+# In-flight requests and smoothed model latency at which each of levels 1-3 kicks in
+QUEUE_DEPTH_THRESHOLDS = _thresholds("DEGRADE_QUEUE_DEPTHS", "8,16,32")
+LATENCY_THRESHOLDS = _thresholds("DEGRADE_LATENCY_SECONDS", "4,8,15")
+LATENCY_SMOOTHING = float(os.environ.get("DEGRADE_LATENCY_SMOOTHING", "0.2"))
+FORCED_LEVEL = os.environ.get("FORCE_DEGRADATION_LEVEL")
+
+
+def _level_for(value, thresholds):
+    level = NORMAL
+    for threshold_level, threshold in enumerate(thresholds, start=1):
+        if value >= threshold:
+            level = threshold_level
+    return level
+
+
+class LoadMonitor:
+    """Tracks queue depth and Vertex latency and turns them into a degradation level."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.model_latency = 0.0
+
+    @contextmanager
+    def track_request(self):
+        with self._lock:
+            self.in_flight += 1
+        metrics.set_gauge("requests_in_flight", self.in_flight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            metrics.set_gauge("requests_in_flight", self.in_flight)
+
+    def record_model_latency(self, seconds, at_least=False):
+        """Folds a model call's duration into the average; at_least marks a call given up on before it
+        finished, whose true latency is longer, so it can only raise the average."""
+        with self._lock:
+            if at_least and seconds <= self.model_latency:
+                return
+            if self.model_latency:
+                self.model_latency += LATENCY_SMOOTHING * (seconds - self.model_latency)
+            else:
+                self.model_latency = seconds
+        metrics.set_gauge("model_latency_ewma_seconds", round(self.model_latency, 3))
+
+    def level(self):
+        if FORCED_LEVEL is not None:
+            return int(FORCED_LEVEL)
+        with self._lock:
+            # The request asking for a level is itself in flight, so don't count it as queued
+            queued = max(0, self.in_flight - 1)
+            latency = self.model_latency
+        return max(_level_for(queued, QUEUE_DEPTH_THRESHOLDS), _level_for(latency, LATENCY_THRESHOLDS))
+
+
+monitor = LoadMonitor()
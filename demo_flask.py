@@ -1,12 +1,32 @@
+import functools
+import json
+import math
 import os
-import tempfile
-from io import BytesIO
-from flask import Flask, request, jsonify
+import queue
+import threading
+import time
+from collections import namedtuple
+from flask import Flask, Response, request, jsonify
 import requests
-from PIL import Image
-import cv2
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
+import cascade
+import categorize
+from circuit_breaker import CircuitBreaker
+from deadline import Deadline, DeadlineExceeded, RequestCancelled, WorkersSaturated
+import degradation
+import disconnect
+import fallback
+import media_fetch
+import metrics
+import model_routing
+import partial_fetch
+import prefetch
+import preprocess
+import preprocess_pool
+import result_cache
+import tiling
+import vertex_pool
 
 # Initialize Vertex AI
 vertexai.init(project="travel-chatbot-409605", location="us-central1")
@@ -27,108 +47,373 @@ Return the categories as terms separated by commas in a list.
 return results in one list
 """
 
-generation_config = {
-    "max_output_tokens": 8192,
-    "temperature": 0.2,
-    "top_p": 0.95,
-}
-
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
-
-def fetch_and_preprocess_image(image_path):
-    if image_path.startswith("http://") or image_path.startswith("https://"):
-        response = requests.get(image_path)
-        image = Image.open(BytesIO(response.content))
-    else:
-        image = Image.open(image_path)
-
-    image = image.resize((224, 224), Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
-
-def fetch_and_preprocess_video(video_path):
-    temp_file_path = None
+# Picks the model and generation_config for each caption, image and frame call
+router = model_routing.ModelRouter(system_instruction)
+
+# Opens after repeated backend failures so incidents are answered locally instead of retried against Vertex
+backend_breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get("BACKEND_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.environ.get("BACKEND_BREAKER_RESET_SECONDS", "30")),
+)
+keyword_categorizer = fallback.KeywordCategorizer.from_system_instruction(system_instruction)
+
+class BackendUnavailable(Exception):
+    """Raised when the model backend failed or its circuit is open."""
+
+# Download failures that drop one media item (broken link, unsupported or oversized file) instead of
+# failing the post
+SKIPPABLE_FETCH_ERRORS = (media_fetch.MediaFetchError, requests.HTTPError, requests.ConnectionError)
+# A slow or unreachable host drops its item too while the request still has time; once the
+# deadline has passed, the timeout goes to the partial-result handling instead
+TIMED_OUT_FETCH_ERRORS = (requests.Timeout,)
+# Items whose download is fine but whose image is over the pixel limits are left out the same way
+SKIPPABLE_MEDIA_ERRORS = (preprocess.ImageTooLarge,)
+
+def is_url(path):
+    return path.startswith("http://") or path.startswith("https://")
+
+def download_image(image_path, deadline):
+    """Returns the downloaded bytes for a URL, or the path itself for a local file."""
+    if is_url(image_path):
+        return partial_fetch.fetch_image(image_path, deadline)
+    return image_path
+
+def preprocess_image(source, deadline=None):
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
+
+def fetch_and_preprocess_image(image_path, deadline=None):
+    deadline = deadline or Deadline()
+    return preprocess_image(download_image(image_path, deadline), deadline)
+
+def download_video(video_path, deadline):
+    """Downloads a video URL to a temp file and returns its path; local paths are returned as they are."""
+    if not is_url(video_path):
+        return video_path
+    # Sniffs the first bytes, so non-video data is dropped before it reaches the disk
+    video_file, _ = media_fetch.fetch_to_temp_file(video_path, deadline)
+    return video_file
+
+def remove_downloaded_video(video_path, video_file):
+    if video_file != video_path and os.path.exists(video_file):
+        os.remove(video_file)
+
+def fetch_and_preprocess_video(video_path, deadline=None, max_frames=5):
+    deadline = deadline or Deadline()
+    video_file = download_video(video_path, deadline)
     try:
-        if video_path.startswith("http://") or video_path.startswith("https://"):
-            response = requests.get(video_path, stream=True)
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tmp")
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
-            temp_file.close()
-            temp_file_path = temp_file.name
-        else:
-            temp_file_path = video_path
-
-        cap = cv2.VideoCapture(temp_file_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {video_path}")
-
-        frames = []
-        success, frame = cap.read()
-        frame_interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / 5)
-
-        while success and len(frames) < 5:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(frame)
-            pil_image = pil_image.resize((224, 224), Image.Resampling.LANCZOS)
-            buffer = BytesIO()
-            pil_image.save(buffer, format="JPEG")
-            frames.append(Part.from_data(mime_type="image/jpeg", data=buffer.getvalue()))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + frame_interval)
-            success, frame = cap.read()
-
-        cap.release()
+        return categorize.extract_frames(video_file, deadline, max_frames, video_path)
     finally:
-        if temp_file_path and temp_file_path != video_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        remove_downloaded_video(video_path, video_file)
+
+def start_prefetch(image_paths, video_paths, deadline):
+    """Starts every download for the post at once so network time overlaps the caption call."""
+    downloads = prefetch.Prefetch(deadline)
+    for image_path in image_paths:
+        downloads.submit(("image", image_path), download_image, image_path, deadline)
+    for video_path in video_paths:
+        downloads.submit(("video", video_path), download_video, video_path, deadline,
+                         cleanup=functools.partial(remove_downloaded_video, video_path))
+    return downloads
+
+# A still image's first-pass part and its high-res part, both from one decode; high_res is None
+# when the image is no bigger than the first pass, which then saw every pixel there is
+CascadeParts = namedtuple("CascadeParts", ["low_res", "high_res"])
+
+def preprocess_download(kind, path, downloaded, deadline, max_frames, progress=None, cascading=False):
+    """Turns a finished download into model parts: one for an image, the sampled frames for a video.
+
+    With cascading set, a still image comes back as CascadeParts instead.
+    """
+    if kind == "image":
+        # Header only: turns away decompression bombs before anything is decoded
+        probe = preprocess.probe(downloaded)
+        metrics.increment("image_pixels_probed", probe.width * probe.height)
+        if probe.frames > 1 and max_frames > 0:
+            # Animated GIF/WebP: sample frames like a video, but in memory and without OpenCV
+            metrics.increment("animated_images")
+            frames = preprocess_pool.preprocess_animation(downloaded, max_frames, deadline)
+            if progress is not None:
+                # Each frame is a model call of its own, not the one call planned for an image
+                progress["extra_frames"] += max(0, len(frames) - 1)
+            return [Part.from_data(mime_type="image/jpeg", data=frame) for frame in frames]
+        if cascading:
+            low_res, high_res = preprocess_pool.preprocess_cascade(downloaded, cascade.LOW_SIZE, cascade.HIGH_SIZE, deadline)
+            return CascadeParts(Part.from_data(mime_type=low_res[0], data=low_res[1]),
+                                high_res and Part.from_data(mime_type=high_res[0], data=high_res[1]))
+        return [preprocess_image(downloaded, deadline)]
+    return categorize.extract_frames(downloaded, deadline, max_frames, path)
+
+def model_inputs(media_parts):
+    """Groups media parts into what each model call sends: one part each, or with tiling on, labeled grids."""
+    if not tiling.TILING or len(media_parts) < 2:
+        return [[media_part] for media_part in media_parts]
+    grids = tiling.tile([media_part.inline_data.data for media_part in media_parts])
+    return [[Part.from_text(tiling.describe(count)), Part.from_data(mime_type="image/jpeg", data=grid)]
+            for grid, count in grids]
+
+def cascade_image(parts, contents, caption_categories, deadline, progress, caption="", on_category=None):
+    """Categorizes an image from its low-res part, and again at high resolution if that answer looks unreliable."""
+    categories = generate_categories(contents + [parts.low_res], deadline, progress, model_routing.IMAGE, caption)
+    reason = cascade.escalation_reason(categories, caption_categories, keyword_categorizer.categories)
+    if parts.high_res is None:
+        reason = None
+    cascade.record(reason)
+    if reason is not None:
+        try:
+            categories = generate_categories(contents + [parts.high_res], deadline, progress, model_routing.IMAGE, caption)
+        except (DeadlineExceeded, requests.Timeout):
+            if not deadline.expired():
+                raise
+            # Out of time for the second look: the first answer is better than none
+            metrics.increment("cascade_escalations_timed_out")
+    # Streamed once settled, so a first-pass answer that gets replaced is never sent
+    if on_category is not None:
+        for category in categories:
+            on_category(category)
+    return categories
+
+def generate_categories(contents, deadline, progress=None, task=model_routing.CAPTION, caption="", on_category=None):
+    """Calls the routed model under the request deadline and records its latency for load tracking."""
+    # Out of time before the call is the request's problem; out of time during it is the backend's
+    deadline.check("model call")
+    if not backend_breaker.allow_request():
+        metrics.increment("backend_breaker_rejections")
+        raise BackendUnavailable("Model backend circuit is open")
+    route = router.route(task, caption, deadline)
+    start = time.monotonic()
+    try:
+        categories = router.generate(route, contents, deadline, on_category)
+    except WorkersSaturated as e:
+        # Refused before any model call ran: our own threads are full, not the backend, and
+        # there's no latency to record
+        backend_breaker.release()
+        raise BackendUnavailable(str(e)) from e
+    except vertex_pool.RETRYABLE_ERRORS + (vertex_pool.NoHealthyRegion,) as e:
+        degradation.monitor.record_model_latency(time.monotonic() - start)
+        backend_breaker.record_failure()
+        metrics.set_gauge("backend_breaker_state", backend_breaker.state)
+        raise BackendUnavailable(str(e)) from e
+    except DeadlineExceeded:
+        # Slow or hung calls are the usual Vertex incident; the breaker has to see them to open
+        degradation.monitor.record_model_latency(time.monotonic() - start, at_least=True)
+        backend_breaker.record_failure()
+        metrics.set_gauge("backend_breaker_state", backend_breaker.state)
+        metrics.increment("model_calls_deadline_exceeded")
+        raise
+    except RequestCancelled:
+        # Says nothing about the backend's health, and the call was cut short
+        degradation.monitor.record_model_latency(time.monotonic() - start, at_least=True)
+        backend_breaker.release()
+        raise
+    except BaseException:
+        # Anything else (a rejected request, a parsing bug) says nothing about the backend's health
+        degradation.monitor.record_model_latency(time.monotonic() - start)
+        backend_breaker.release()
+        raise
+    degradation.monitor.record_model_latency(time.monotonic() - start)
+    backend_breaker.record_success()
+    metrics.set_gauge("backend_breaker_state", backend_breaker.state)
+    if progress is not None:
+        progress["model_calls"] += 1
+    return categories
+
+def new_progress():
+    """What a request has done so far; extra_frames counts animated image frames beyond the first."""
+    return {"model_calls": 0, "media_items": 0, "extra_frames": 0}
+
+def planned_model_calls(image_paths, video_paths, level, extra_frames=0):
+    if level >= degradation.COMBINED_CALL:
+        return 1
+    if tiling.TILING:
+        return 1 + math.ceil((len(image_paths) + extra_frames) / tiling.MAX_TILES) + len(video_paths)
+    image_calls = len(image_paths) + extra_frames
+    if cascade.CASCADE:
+        # Each image's possible second pass, at the rate first passes have been escalating
+        image_calls += math.ceil(len(image_paths) * cascade.escalation_rate())
+    return 1 + image_calls + len(video_paths) * degradation.FRAME_BUDGETS[level]
+
+def record_cancelled_work(image_paths, video_paths, level, progress):
+    """Counts the fetches and model calls a cancelled request no longer has to make."""
+    metrics.increment("requests_cancelled")
+    metrics.increment("media_items_skipped_on_cancel", len(image_paths) + len(video_paths) - progress["media_items"])
+    metrics.increment("model_calls_skipped_on_cancel", max(0, planned_model_calls(image_paths, video_paths, level, progress["extra_frames"]) - progress["model_calls"]))
 
-    return frames
+def fallback_categories(caption, image_paths, video_paths):
+    """Answers from the result cache, or from keywords and hashtags in the caption, without calling the model."""
+    cached = result_cache.get(result_cache.make_key(caption, image_paths, video_paths))
+    if cached is not None:
+        metrics.increment("fallback_served_from_cache")
+        return cached
+    metrics.increment("fallback_served_from_keywords")
+    return keyword_categorizer.categorize(caption)
 
-def predict_categories(caption, image_paths, video_paths):
+def degraded_response(caption, image_paths, video_paths, level):
+    predicted_categories = fallback_categories(caption, image_paths, video_paths)
+    if not predicted_categories:
+        return {"error": "Model backend unavailable", "degraded": True, "degradation_level": level}, 503
+    return {"predicted_categories": predicted_categories, "partial": False, "degraded": True, "degradation_level": level}, 200
+
+def predict_categories(caption, image_paths, video_paths, deadline=None, level=degradation.NORMAL, progress=None, on_category=None):
+    deadline = deadline or Deadline()
+    progress = progress if progress is not None else new_progress()
     contents = [Part.from_text(caption)]
-    unique_categories = set()
+    partial = False
+    max_frames = degradation.FRAME_BUDGETS[level]
+    cache_key = result_cache.make_key(caption, image_paths, video_paths)
 
-    # Process the text caption separately
-    response = model.generate_content(contents, generation_config=generation_config)
-    categories = response.text.strip().split(", ")
-    unique_categories.update(categories)
+    if level >= degradation.CAPTION_ONLY:
+        # Under heavy load answer from an earlier full result, or from the caption alone
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            if on_category is not None:
+                for category in cached:
+                    on_category(category)
+            return cached, partial
+        return generate_categories(contents, deadline, progress, model_routing.CAPTION, caption, on_category), partial
 
-    for image_path in image_paths:
-        image_part = fetch_and_preprocess_image(image_path)
-        content = contents + [image_part]
-        response = model.generate_content(content, generation_config=generation_config)
-        categories = response.text.strip().split(", ")
-        unique_categories.update(categories)
+    downloads = start_prefetch(image_paths, video_paths, deadline)
+    try:
+        if level >= degradation.COMBINED_CALL:
+            # One call per post: caption, images and sampled frames together
+            media_parts = []
+            for (kind, path), downloaded in downloads.completed(SKIPPABLE_FETCH_ERRORS, TIMED_OUT_FETCH_ERRORS):
+                try:
+                    media_parts.extend(preprocess_download(kind, path, downloaded, deadline, max_frames, progress))
+                except SKIPPABLE_MEDIA_ERRORS as e:
+                    downloads.skipped.append(((kind, path), e))
+                    continue
+                progress["media_items"] += 1
+            media_parts = [media_part for parts in model_inputs(media_parts) for media_part in parts]
+            return generate_categories(contents + media_parts, deadline, progress, model_routing.COMBINED, caption, on_category), partial
 
-    for video_path in video_paths:
-        video_frames = fetch_and_preprocess_video(video_path)
-        for frame in video_frames:
-            content = contents + [frame]
-            response = model.generate_content(content, generation_config=generation_config)
-            categories = response.text.strip().split(", ")
-            unique_categories.update(categories)
+        # Process the text caption separately, while the media downloads
+        caption_categories = generate_categories(contents, deadline, progress, model_routing.CAPTION, caption, on_category)
+
+        def media_categories():
+            image_parts = []
+            for (kind, path), downloaded in downloads.completed(SKIPPABLE_FETCH_ERRORS, TIMED_OUT_FETCH_ERRORS):
+                cascading = cascade.CASCADE and kind == "image" and not tiling.TILING
+                try:
+                    media_parts = preprocess_download(kind, path, downloaded, deadline, max_frames, progress, cascading)
+                except SKIPPABLE_MEDIA_ERRORS as e:
+                    # One oversized image shouldn't fail the rest of the post
+                    downloads.skipped.append(((kind, path), e))
+                    continue
+                progress["media_items"] += 1
+                if tiling.TILING and kind == "image":
+                    # Held back until every image is in, then sent together as a grid
+                    image_parts.extend(media_parts)
+                    continue
+                if isinstance(media_parts, CascadeParts):
+                    yield cascade_image(media_parts, contents, caption_categories, deadline, progress, caption, on_category)
+                    continue
+                task = model_routing.IMAGE if kind == "image" else model_routing.VIDEO_FRAME
+                for media_input in model_inputs(media_parts):
+                    yield generate_categories(contents + media_input, deadline, progress, task, caption, on_category)
+            for media_input in model_inputs(image_parts):
+                yield generate_categories(contents + media_input, deadline, progress, model_routing.IMAGE, caption, on_category)
+
+        unique_categories, partial = categorize.collect(media_categories(), deadline, caption_categories)
+    finally:
+        downloads.close()
+        metrics.increment("media_items_skipped_on_fetch_error", len(downloads.skipped))
 
-    return list(unique_categories)
+    # A result missing a broken item's categories isn't cached, so it's retried once the link works
+    if not partial and not downloads.skipped:
+        result_cache.put(cache_key, unique_categories)
+    return unique_categories, partial
 
 app = Flask(__name__)
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    data = request.json
+def read_post(data):
     caption = data.get('caption', '').strip()
     image_paths = [url.strip() for url in data.get('image_urls', []) if url.strip()]
     video_paths = [url.strip() for url in data.get('video_urls', []) if url.strip()]
+    return caption, image_paths, video_paths
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    caption, image_paths, video_paths = read_post(request.json)
 
     if not caption or (not image_paths and not video_paths):
         return jsonify({"error": "Please provide a caption and at least one image or video URL."}), 400
 
-    try:
-        predicted_categories = predict_categories(caption, image_paths, video_paths)
-        return jsonify({"predicted_categories": predicted_categories}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    deadline = Deadline.from_request(request)
+    progress = new_progress()
+    with degradation.monitor.track_request(), disconnect.cancel_on_disconnect(request.environ, deadline):
+        level = degradation.monitor.level()
+        metrics.set_gauge("degradation_level", level)
+        metrics.increment(f"requests_at_degradation_level_{level}")
+        try:
+            predicted_categories, partial = predict_categories(caption, image_paths, video_paths, deadline, level, progress)
+            return jsonify({"predicted_categories": predicted_categories, "partial": partial, "degraded": False, "degradation_level": level}), 200
+        except RequestCancelled as e:
+            # Nobody is listening any more; 499 is the conventional "client closed request" status
+            record_cancelled_work(image_paths, video_paths, level, progress)
+            return jsonify({"error": str(e)}), 499
+        except BackendUnavailable:
+            body, status = degraded_response(caption, image_paths, video_paths, level)
+            return jsonify(body), status
+        except (DeadlineExceeded, requests.Timeout) as e:
+            return jsonify({"error": str(e), "degradation_level": level}), 504
+        except Exception as e:
+            return jsonify({"error": str(e), "degradation_level": level}), 500
+
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream():
+    """Like /predict, but sends each new category as an NDJSON line as soon as the model produces it."""
+    caption, image_paths, video_paths = read_post(request.json)
+
+    if not caption or (not image_paths and not video_paths):
+        return jsonify({"error": "Please provide a caption and at least one image or video URL."}), 400
+
+    deadline = Deadline.from_request(request)
+    events = queue.Queue()
+    seen = set()
+
+    def on_category(category):
+        if category not in seen:
+            seen.add(category)
+            events.put({"category": category})
+
+    def run():
+        progress = new_progress()
+        with degradation.monitor.track_request():
+            level = degradation.monitor.level()
+            metrics.set_gauge("degradation_level", level)
+            metrics.increment(f"requests_at_degradation_level_{level}")
+            try:
+                predicted_categories, partial = predict_categories(caption, image_paths, video_paths, deadline, level, progress, on_category)
+                events.put({"predicted_categories": predicted_categories, "partial": partial, "degraded": False, "degradation_level": level})
+            except RequestCancelled:
+                record_cancelled_work(image_paths, video_paths, level, progress)
+            except BackendUnavailable:
+                events.put(degraded_response(caption, image_paths, video_paths, level)[0])
+            except Exception as e:
+                events.put({"error": str(e), "degradation_level": level})
+            finally:
+                events.put(None)
+
+    def generate():
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    return
+                yield json.dumps(event) + "\n"
+        finally:
+            # The server closes the generator early when the client goes away
+            deadline.cancel()
+
+    threading.Thread(target=run, daemon=True).start()
+    return Response(generate(), mimetype="application/x-ndjson")
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["routing_agreement"] = router.agreement_table()
+    return jsonify(snapshot), 200
 
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
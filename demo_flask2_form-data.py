@@ -1,12 +1,15 @@
 import os
 import tempfile
-from io import BytesIO
 from flask import Flask, request, jsonify
 import requests
-from PIL import Image
-import cv2
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
+from deadline import Deadline, DeadlineExceeded
+import media_fetch
+import media_sniff
+import categorize
+import partial_fetch
+import preprocess_pool
 
 # Initialize Vertex AI
 vertexai.init(project="travel-chatbot-409605", location="us-central1")
@@ -23,93 +26,62 @@ generation_config = {
     "top_p": 0.95,
 }
 
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
+model = categorize.regional_model(system_instruction)
 
-def fetch_and_preprocess_image(image_path_or_file):
+def fetch_and_preprocess_image(image_path_or_file, deadline=None):
+    deadline = deadline or Deadline()
     if isinstance(image_path_or_file, str):
         if image_path_or_file.startswith("http://") or image_path_or_file.startswith("https://"):
-            response = requests.get(image_path_or_file)
-            image = Image.open(BytesIO(response.content))
+            source = partial_fetch.fetch_image(image_path_or_file, deadline)
         else:
-            image = Image.open(image_path_or_file)
+            source = image_path_or_file
     else:
-        image = Image.open(image_path_or_file)
+        source = image_path_or_file
 
-    image = image.resize((224, 224), Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
 
-def fetch_and_preprocess_video(video_path_or_file):
+def fetch_and_preprocess_video(video_path_or_file, deadline=None):
+    deadline = deadline or Deadline()
     temp_file_path = None
     try:
         if isinstance(video_path_or_file, str):
             if video_path_or_file.startswith("http://") or video_path_or_file.startswith("https://"):
-                response = requests.get(video_path_or_file, stream=True)
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tmp")
-                for chunk in response.iter_content(chunk_size=8192):
-                    temp_file.write(chunk)
-                temp_file.close()
-                temp_file_path = temp_file.name
+                temp_file_path, _ = media_fetch.fetch_to_temp_file(video_path_or_file, deadline)
             else:
                 temp_file_path = video_path_or_file
         else:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tmp")
+            # Check the upload is really a video before writing it out, and keep its container as the suffix
+            media = media_sniff.sniff(video_path_or_file.read(media_sniff.SNIFF_BYTES))
+            if media is None or media.kind != media_sniff.VIDEO:
+                raise ValueError(f"Unsupported video format: {video_path_or_file.filename}")
+            video_path_or_file.seek(0)
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=media.suffix)
             temp_file.write(video_path_or_file.read())
             temp_file.close()
             temp_file_path = temp_file.name
 
-        cap = cv2.VideoCapture(temp_file_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {video_path_or_file}")
-
-        frames = []
-        success, frame = cap.read()
-        frame_interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / 5)
-
-        while success and len(frames) < 5:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(frame)
-            pil_image = pil_image.resize((224, 224), Image.Resampling.LANCZOS)
-            buffer = BytesIO()
-            pil_image.save(buffer, format="JPEG")
-            frames.append(Part.from_data(mime_type="image/jpeg", data=buffer.getvalue()))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + frame_interval)
-            success, frame = cap.read()
-
-        cap.release()
+        return categorize.extract_frames(temp_file_path, deadline, 5, video_path_or_file)
     finally:
         if temp_file_path and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
 
-    return frames
-
-def predict_categories(caption, image_paths_or_files, video_paths_or_files):
+def predict_categories(caption, image_paths_or_files, video_paths_or_files, deadline=None):
+    deadline = deadline or Deadline()
     contents = [Part.from_text(caption)]
-    unique_categories = set()
-
     # Process the text caption separately
-    response = model.generate_content(contents, generation_config=generation_config)
-    categories = response.text.strip().split(", ")
-    unique_categories.update(categories)
-
-    for image_path_or_file in image_paths_or_files:
-        image_part = fetch_and_preprocess_image(image_path_or_file)
-        content = contents + [image_part]
-        response = model.generate_content(content, generation_config=generation_config)
-        categories = response.text.strip().split(", ")
-        unique_categories.update(categories)
-
-    for video_path_or_file in video_paths_or_files:
-        video_frames = fetch_and_preprocess_video(video_path_or_file)
-        for frame in video_frames:
-            content = contents + [frame]
-            response = model.generate_content(content, generation_config=generation_config)
-            categories = response.text.strip().split(", ")
-            unique_categories.update(categories)
-
-    return list(unique_categories)
+    caption_categories = categorize.generate_categories(model, contents, deadline, generation_config)
+
+    def media_categories():
+        for image_path_or_file in image_paths_or_files:
+            image_part = fetch_and_preprocess_image(image_path_or_file, deadline)
+            yield categorize.generate_categories(model, contents + [image_part], deadline, generation_config)
+
+        for video_path_or_file in video_paths_or_files:
+            for frame in fetch_and_preprocess_video(video_path_or_file, deadline):
+                yield categorize.generate_categories(model, contents + [frame], deadline, generation_config)
+
+    return categorize.collect(media_categories(), deadline, caption_categories)
 
 app = Flask(__name__)
 
@@ -122,9 +94,12 @@ def predict():
     if not caption or (not image_files and not video_files):
         return jsonify({"error": "Please provide a caption and at least one image or video file."}), 400
 
+    deadline = Deadline.from_request(request)
     try:
-        predicted_categories = predict_categories(caption, image_files, video_files)
-        return jsonify({"predicted_categories": predicted_categories}), 200
+        predicted_categories, partial = predict_categories(caption, image_files, video_files, deadline)
+        return jsonify({"predicted_categories": predicted_categories, "partial": partial}), 200
+    except (DeadlineExceeded, requests.Timeout) as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
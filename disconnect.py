@@ -0,0 +1,57 @@
+import os
+import select
+import socket
+import ssl
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+POLL_INTERVAL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", "0.25"))
+# Servers that expose the client connection in the WSGI environ
+_SOCKET_KEYS = ("werkzeug.socket", "gunicorn.socket")
+
+
+def client_socket(environ):
+    for key in _SOCKET_KEYS:
+        sock = environ.get(key)
+        # TLS sockets can't be peeked without consuming data, so they are not watched
+        if isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket):
+            return sock
+    return None
+
+
+def is_disconnected(sock):
+    """Returns True once the peer has closed its end of the connection."""
+    try:
+        if sock.fileno() < 0:
+            return True
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A readable socket with nothing to read has reached EOF; pipelined data means the client is still there
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+@contextmanager
+def cancel_on_disconnect(environ, deadline):
+    """Watches the client connection for the duration of the block and cancels the deadline if it drops."""
+    sock = client_socket(environ)
+    if sock is None:
+        yield
+        return
+
+    stop = threading.Event()
+
+    def watch():
+        while not stop.wait(POLL_INTERVAL_SECONDS):
+            if is_disconnected(sock):
+                metrics.increment("client_disconnects")
+                deadline.cancel()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
@@ -0,0 +1,83 @@
+import math
+import re
+from collections import defaultdict
+
+from streaming import CategoryStreamParser
+
+# "new" says nothing about the topic ("New phone unboxing" isn't about New Parents)
+STOP_WORDS = {"a", "an", "and", "e", "g", "eg", "for", "in", "of", "on", "or", "the", "to", "with", "specific", "new"}
+# Words whose trailing s isn't a plural, so stemming would turn them into a different word
+UNSTEMMED = {"news", "series", "species"}
+NAME_WEIGHT = 2.0
+EXAMPLE_WEIGHT = 1.0
+HASHTAG_BOOST = 2.0
+# Drop matches scoring less than this share of the best one
+MIN_RELATIVE_SCORE = 0.5
+
+
+def _stem(word):
+    # Just enough to match "pets"/"pet" and "recipes"/"recipe"; not a real stemmer. Leaves alone
+    # "-ss", "-us" and "-is" endings ("fitness", "campus", "tennis") and the UNSTEMMED words.
+    if len(word) <= 3 or not word.endswith("s") or word.endswith(("ss", "us", "is")) or word in UNSTEMMED:
+        return word
+    return word[:-1]
+
+
+def tokenize(text):
+    return [_stem(word) for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS]
+
+
+def hashtag_words(caption):
+    """Splits #CamelCase and #snake_case hashtags into words."""
+    words = []
+    for tag in re.findall(r"#(\w+)", caption):
+        words.extend(re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", tag.replace("_", " ")))
+    return tokenize(" ".join(words))
+
+
+def parse_category_list(system_instruction):
+    """Pulls the category names out of a prompt's CATEGORIES_LIST={...} block."""
+    match = re.search(r"CATEGORIES_LIST=\{(.*)\}", system_instruction)
+    if not match:
+        return []
+    parser = CategoryStreamParser(max_categories=math.inf)
+    parser.feed(match.group(1))
+    parser.finish()
+    # The list repeats a few entries; keep the first of each
+    return list(dict.fromkeys(parser.categories))
+
+
+class KeywordCategorizer:
+    """Scores captions against the category list by keyword and hashtag overlap, without calling a model."""
+
+    def __init__(self, categories):
+        self.categories = categories
+        self._order = {category: position for position, category in enumerate(categories)}
+        self._index = defaultdict(list)
+        for category in categories:
+            name, _, examples = category.partition("(")
+            weights = {}
+            for token in tokenize(examples):
+                weights[token] = EXAMPLE_WEIGHT
+            for token in tokenize(name):
+                weights[token] = NAME_WEIGHT
+            # Long names shouldn't win just by having more words to match
+            norm = math.sqrt(len(weights)) or 1.0
+            for token, weight in weights.items():
+                self._index[token].append((category, weight / norm))
+
+    @classmethod
+    def from_system_instruction(cls, system_instruction):
+        return cls(parse_category_list(system_instruction))
+
+    def categorize(self, caption, top_k=5):
+        scores = defaultdict(float)
+        for tokens, boost in ((tokenize(caption), 1.0), (hashtag_words(caption), HASHTAG_BOOST)):
+            for token in set(tokens):
+                for category, weight in self._index.get(token, ()):
+                    scores[category] += weight * boost
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self._order[item[0]]))
+        if not ranked:
+            return []
+        cutoff = ranked[0][1] * MIN_RELATIVE_SCORE
+        return [category for category, score in ranked[:top_k] if score >= cutoff]
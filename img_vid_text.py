@@ -1,13 +1,15 @@
 import os
-import tempfile
-from io import BytesIO
 from flask import Flask, request, jsonify
 import requests
-from PIL import Image
-import cv2
 import numpy as np
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
+from deadline import Deadline, DeadlineExceeded
+import media_fetch
+import media_sniff
+import categorize
+import partial_fetch
+import preprocess_pool
 
 # Initialize Vertex AI
 vertexai.init(project="travel-chatbot-409605", location="us-central1")
@@ -34,84 +36,50 @@ generation_config = {
     "top_p": 0.95,
 }
 
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
+model = categorize.regional_model(system_instruction)
 
-def fetch_and_preprocess_image(image_path):
+def fetch_and_preprocess_image(image_path, deadline=None):
+    deadline = deadline or Deadline()
     if image_path.startswith("http://") or image_path.startswith("https://"):
-        response = requests.get(image_path)
-        image = Image.open(BytesIO(response.content))
+        source = partial_fetch.fetch_image(image_path, deadline)
     else:
-        image = Image.open(image_path)
+        source = image_path
 
-    image = image.resize((224, 224), Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
 
-def fetch_and_preprocess_video(video_path):
+def fetch_and_preprocess_video(video_path, deadline=None):
+    deadline = deadline or Deadline()
     temp_file_path = None
-    supported_formats = ['.mp4', '.mov', '.avi', '.mkv', '.3gp', '.flv']
 
     try:
         if video_path.startswith("http://") or video_path.startswith("https://"):
-            response = requests.get(video_path, stream=True)
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mkv")
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
-            temp_file.close()
-            temp_file_path = temp_file.name
+            temp_file_path, _ = media_fetch.fetch_to_temp_file(video_path, deadline)
         else:
             temp_file_path = video_path
+            # Go by the content, not the name; downloads are sniffed the same way as they arrive
+            media = media_sniff.sniff_file(video_path)
+            if media is None or media.kind != media_sniff.VIDEO:
+                raise ValueError(f"Unsupported video format: {video_path}")
 
-        if not any(temp_file_path.endswith(ext) for ext in supported_formats):
-            raise ValueError(f"Unsupported video format: {video_path}")
-
-        cap = cv2.VideoCapture(temp_file_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {video_path}")
-
-        frames = []
-        success, frame = cap.read()
-        frame_interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / 5)
-
-        while success and len(frames) < 5:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(frame)
-            pil_image = pil_image.resize((224, 224), Image.Resampling.LANCZOS)
-            buffer = BytesIO()
-            pil_image.save(buffer, format="JPEG")
-            frames.append(Part.from_data(mime_type="image/jpeg", data=buffer.getvalue()))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + frame_interval)
-            success, frame = cap.read()
-
-        cap.release()
+        return categorize.extract_frames(temp_file_path, deadline, 5, video_path)
     finally:
         if temp_file_path and temp_file_path != video_path and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
 
-    return frames
-
-def predict_categories(caption, image_paths, video_paths):
+def predict_categories(caption, image_paths, video_paths, deadline=None):
+    deadline = deadline or Deadline()
     contents = [Part.from_text(caption)]
-    unique_categories = set()
-
-    for image_path in image_paths:
-        image_part = fetch_and_preprocess_image(image_path)
-        content = contents + [image_part]
-        response = model.generate_content(content, generation_config=generation_config)
-        categories = response.text.strip().split(", ")
-        unique_categories.update(categories)
+    def media_categories():
+        for image_path in image_paths:
+            image_part = fetch_and_preprocess_image(image_path, deadline)
+            yield categorize.generate_categories(model, contents + [image_part], deadline, generation_config)
 
-    for video_path in video_paths:
-        video_frames = fetch_and_preprocess_video(video_path)
-        for frame in video_frames:
-            content = contents + [frame]
-            response = model.generate_content(content, generation_config=generation_config)
-            categories = response.text.strip().split(", ")
-            unique_categories.update(categories)
+        for video_path in video_paths:
+            for frame in fetch_and_preprocess_video(video_path, deadline):
+                yield categorize.generate_categories(model, contents + [frame], deadline, generation_config)
 
-    return list(unique_categories)
+    return categorize.collect(media_categories(), deadline)
 
 app = Flask(__name__)
 
@@ -125,9 +93,12 @@ def predict():
     if not caption or (not image_paths and not video_paths):
         return jsonify({"error": "Please provide a caption and at least one image or video URL."}), 400
 
+    deadline = Deadline.from_request(request)
     try:
-        predicted_categories = predict_categories(caption, image_paths, video_paths)
-        return jsonify({"predicted_categories": predicted_categories}), 200
+        predicted_categories, partial = predict_categories(caption, image_paths, video_paths, deadline)
+        return jsonify({"predicted_categories": predicted_categories, "partial": partial}), 200
+    except (DeadlineExceeded, requests.Timeout) as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
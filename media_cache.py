@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import metrics
+
+# Opt-in: keep fetched media on local disk and revalidate it with conditional GETs instead of re-downloading
+MEDIA_CACHE = os.environ.get("MEDIA_CACHE", "0") == "1"
+CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "media_cache"))
+MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# One entry may take at most this share of the cache, so a single long video can't flush everything else
+MAX_ENTRY_FRACTION = 0.25
+# Other processes sharing the directory store bodies we don't see, so usage is re-read at least this often
+RESCAN_SECONDS = float(os.environ.get("MEDIA_CACHE_RESCAN_SECONDS", "60"))
+
+# A cached response's validators; expires is wall-clock time because entries outlive the process
+Entry = namedtuple("Entry", ["key", "url", "etag", "last_modified", "expires", "size"])
+
+
+def freshness(headers):
+    """Seconds a response may be reused without revalidating, or None if it mustn't be stored."""
+    directives = {}
+    for directive in headers.get("Cache-Control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name] = value.strip('"')
+    if "no-store" in directives:
+        return None
+    max_age = directives.get("max-age", "")
+    if "no-cache" in directives or not max_age.isdigit():
+        return 0
+    return int(max_age)
+
+
+def validators(entry):
+    """Conditional request headers for revalidating entry."""
+    headers = {}
+    if entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+
+def _write_atomically(path, data):
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def _link_or_copy(source, destination):
+    """Puts source's content at destination in one step, sharing the inode when both are on one filesystem."""
+    temp = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, destination)
+
+
+class MediaCache:
+    """Bounded on-disk store of fetched media and its validators, evicted least recently used first by bytes.
+
+    Bodies are never modified in place, only replaced, so a reader or a linked copy never sees a torn file.
+    The bound is on the directory, not the process: usage is re-read from disk before every eviction, and
+    the last-use order is the bodies' mtimes, so processes sharing the directory share one budget. Between
+    scans, usage is the last scan's total plus what this process has stored since; the directory is only
+    scanned again once that passes max_bytes or RESCAN_SECONDS have gone by. An entry stored by another
+    process is picked up on lookup; one evicted by another process reads as a miss.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # One directory scan at a time per process
+        self._evict_lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bytes on disk at the last scan, and bytes this process has stored since that scan started
+        self._scanned_bytes = 0
+        self._stored_bytes = 0
+        self._scanned_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def path(self, entry):
+        return self._path(entry.key)
+
+    def _path(self, key, suffix=""):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + suffix)
+
+    def _load(self):
+        """Rebuilds the index from the metadata left by earlier processes, ordered by last use."""
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            entry = self._read_entry(os.path.join(self.directory, name))
+            if entry is None:
+                continue
+            try:
+                found.append((os.path.getmtime(self._path(entry.key)), entry))
+            except OSError:
+                continue
+        with self._lock:
+            for _, entry in sorted(found, key=lambda item: item[0]):
+                self._entries[entry.key] = entry
+        self._evict(force=True)
+
+    def _read_entry(self, path):
+        try:
+            with open(path) as file:
+                return Entry(**json.load(file))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _usage(self):
+        """(mtime, size, name) of every body in the directory, whichever process stored it."""
+        bodies = []
+        with os.scandir(self.directory) as scan:
+            for item in scan:
+                # Bodies are bare sha256 names; metadata ends in .json and writes in progress in .tmp
+                if len(item.name) != 64 or "." in item.name:
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                bodies.append((stat.st_mtime, stat.st_size, item.name))
+        return bodies
+
+    def _scan_due(self):
+        with self._lock:
+            return (self._scanned_bytes + self._stored_bytes > self.max_bytes
+                    or time.monotonic() - self._scanned_at >= RESCAN_SECONDS)
+
+    def _evict(self, force=False):
+        """Removes the least recently used bodies until the directory is back under max_bytes."""
+        if not force and not self._scan_due():
+            return
+        with self._evict_lock:
+            # Another thread may have scanned while we waited for the lock
+            if not force and not self._scan_due():
+                return
+            with self._lock:
+                # Stores that finish during the scan count again on top of it, which only brings the next scan forward
+                self._stored_bytes = 0
+            bodies = self._usage()
+            metrics.increment("media_cache_scans")
+            size = sum(body_size for _, body_size, _ in bodies)
+            evicted = set()
+            for _, body_size, name in sorted(bodies):
+                if size <= self.max_bytes:
+                    break
+                self._remove_files(name)
+                evicted.add(name)
+                size -= body_size
+                metrics.increment("media_cache_evictions")
+            with self._lock:
+                self._scanned_bytes = size
+                self._scanned_at = time.monotonic()
+                for key in [key for key in self._entries if os.path.basename(self._path(key)) in evicted]:
+                    del self._entries[key]
+        metrics.set_gauge("media_cache_bytes", size)
+
+    def _remove_files(self, name):
+        for path in (os.path.join(self.directory, name + ".json"), os.path.join(self.directory, name)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _touch(self, entry):
+        # The body's mtime is the last-use time _load orders by after a restart
+        try:
+            os.utime(self._path(entry.key))
+        except OSError:
+            pass
+
+    def lookup(self, key):
+        """Returns the Entry cached for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            # Maybe another process sharing the directory stored it
+            entry = self._read_entry(self._path(key, ".json"))
+            if entry is not None and entry.key == key and os.path.exists(self._path(key)):
+                with self._lock:
+                    self._entries[key] = entry
+            else:
+                entry = None
+        metrics.increment("media_cache_lookups")
+        return entry
+
+    def read(self, entry):
+        """Returns the cached body, or None if it has gone from disk."""
+        try:
+            with open(self._path(entry.key), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            self._forget(entry.key)
+            return None
+        self._touch(entry)
+        return data
+
+    def copy_to(self, entry, destination):
+        """Replaces destination with the cached body; False if it has gone from disk."""
+        try:
+            _link_or_copy(self._path(entry.key), destination)
+        except FileNotFoundError:
+            self._forget(entry.key)
+            return False
+        self._touch(entry)
+        return True
+
+    def store(self, key, url, headers, data=None, path=None):
+        """Caches a full response body, given as bytes or as a file.
+
+        Skipped when the response forbids storing, has nothing to revalidate with, or is too big.
+        """
+        lifetime = freshness(headers)
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        size = len(data) if data is not None else os.path.getsize(path)
+        if lifetime is None or not (lifetime or etag or last_modified) or size > self.max_bytes * MAX_ENTRY_FRACTION:
+            metrics.increment("media_cache_not_stored")
+            return
+        entry = Entry(key, url, etag, last_modified, time.time() + lifetime, size)
+        try:
+            if data is not None:
+                _write_atomically(self._path(key), data)
+            else:
+                _link_or_copy(path, self._path(key))
+            self._save(entry, size)
+        except OSError:
+            # A full or read-only disk costs the cache, not the request
+            metrics.increment("media_cache_errors")
+
+    def revalidated(self, entry, headers):
+        """Records a 304: the entry is fresh again for as long as the new headers allow."""
+        entry = entry._replace(etag=headers.get("ETag") or entry.etag,
+                               last_modified=headers.get("Last-Modified") or entry.last_modified,
+                               expires=time.time() + (freshness(headers) or 0))
+        try:
+            self._save(entry)
+        except OSError:
+            metrics.increment("media_cache_errors")
+
+    def _save(self, entry, stored_bytes=0):
+        _write_atomically(self._path(entry.key, ".json"), json.dumps(entry._asdict()).encode())
+        with self._lock:
+            self._entries[entry.key] = entry
+            self._entries.move_to_end(entry.key)
+            self._stored_bytes += stored_bytes
+        self._evict()
@@ -0,0 +1,342 @@
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NameResolutionError
+
+import canonical_url
+from deadline import Deadline, DeadlineExceeded
+import media_cache
+import media_sniff
+import metrics
+import negative_cache
+from single_flight import SingleFlight
+
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get("MEDIA_CONNECT_TIMEOUT_SECONDS", "3.05"))
+READ_TIMEOUT_SECONDS = float(os.environ.get("MEDIA_READ_TIMEOUT_SECONDS", "10"))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(25 * 1024 * 1024)))
+MAX_VIDEO_BYTES = int(os.environ.get("MAX_VIDEO_BYTES", str(200 * 1024 * 1024)))
+MAX_RETRIES = int(os.environ.get("MEDIA_FETCH_RETRIES", "2"))
+RETRY_BACKOFF_SECONDS = float(os.environ.get("MEDIA_FETCH_BACKOFF_SECONDS", "0.2"))
+# Keep-alive connections kept per host, and requests allowed in flight to one host at a time
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("MEDIA_MAX_CONNECTIONS_PER_HOST", "16"))
+MAX_CONCURRENCY_PER_HOST = int(os.environ.get("MEDIA_MAX_CONCURRENCY_PER_HOST", "8"))
+CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Not remembered as failures: a signed URL with an expired token shares its canonical key with
+# freshly signed ones, and 408/429 are about the moment, not the URL
+UNREMEMBERED_STATUSES = {401, 403, 408, 429}
+
+
+class MediaFetchError(Exception):
+    """Raised when a media URL can't be fetched."""
+
+
+class MediaTooLarge(MediaFetchError):
+    """Raised when a media file is bigger than the configured cap."""
+
+
+class UnsupportedMedia(MediaFetchError):
+    """Raised when a download's leading bytes aren't a supported image or video format."""
+
+
+class MediaUnavailable(MediaFetchError):
+    """Raised without a request when the URL failed recently; kind is the negative_cache failure kind."""
+
+    def __init__(self, message, kind):
+        super().__init__(message)
+        self.kind = kind
+
+
+def failure_kind(error):
+    """The negative_cache kind for a fetch error, or None if it says nothing lasting about the URL."""
+    if isinstance(error, MediaTooLarge):
+        return negative_cache.TOO_LARGE
+    if isinstance(error, UnsupportedMedia):
+        return negative_cache.UNSUPPORTED
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status in UNREMEMBERED_STATUSES:
+            return None
+        if status == 404:
+            return negative_cache.NOT_FOUND
+        if status == 410:
+            return negative_cache.GONE
+        return negative_cache.SERVER_ERROR if status >= 500 else negative_cache.CLIENT_ERROR
+    # ConnectTimeout is both a Timeout and a ConnectionError
+    if isinstance(error, requests.Timeout):
+        return negative_cache.TIMEOUT
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return negative_cache.DNS if isinstance(reason, NameResolutionError) else negative_cache.CONNECTION
+    return None
+
+
+def is_auth_failure(error):
+    """True for a 401/403, which may only apply to one signed variant of a canonical URL."""
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in (401, 403))
+
+
+def failure_key(key, kind, kinds, max_bytes):
+    """The negative_cache key for a failure of kind; being the wrong kind or too big only holds for one request's limits."""
+    if kind in (negative_cache.UNSUPPORTED, negative_cache.TOO_LARGE):
+        return (key, kind, kinds and tuple(sorted(kinds)), max_bytes)
+    return key
+
+
+class MediaFetcher:
+    """Shared HTTP client for media downloads: pooled keep-alive connections, timeouts, size caps and retries."""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT_SECONDS, read_timeout=READ_TIMEOUT_SECONDS,
+                 max_retries=MAX_RETRIES, max_concurrency_per_host=MAX_CONCURRENCY_PER_HOST, cache=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.max_concurrency_per_host = max_concurrency_per_host
+        # Optional media_cache.MediaCache for whole-file fetches
+        self.cache = cache
+        # Concurrent in-memory fetches of one asset share a single download
+        self._in_flight = SingleFlight()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._host_slots = {}
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_concurrency_per_host)
+            return self._host_slots[host]
+
+    def _timeout(self, deadline):
+        remaining = deadline.check("media fetch")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def _get(self, url, deadline, headers=None):
+        """GETs url as a stream, retrying connection errors and retryable statuses with jittered backoff."""
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.get(url, stream=True, timeout=self._timeout(deadline), headers=headers)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    if not response.ok:
+                        response.close()
+                    response.raise_for_status()
+                    return response
+                response.close()
+            metrics.increment("media_fetch_retries")
+            # Full jitter keeps retries from many workers from landing on the CDN together
+            time.sleep(min(random.uniform(0, RETRY_BACKOFF_SECONDS * 2 ** attempt), deadline.remaining()))
+
+    @contextmanager
+    def open(self, url, deadline=None, max_bytes=MAX_IMAGE_BYTES, headers=None, kinds=None):
+        """Yields the streamed response for url once its headers are in and its Content-Length is within max_bytes.
+
+        URLs that failed recently raise MediaUnavailable straight away; failures that say something
+        about the URL (including errors raised while reading the body) are remembered for next time.
+        A file that was too big or the wrong kind is only skipped for callers with the same max_bytes
+        and kinds, which the caller sniffing the body passes here.
+        """
+        deadline = deadline or Deadline()
+        key = canonical_url.canonicalize(url)
+        for remembered in (None, negative_cache.UNSUPPORTED, negative_cache.TOO_LARGE):
+            failure = negative_cache.get(failure_key(key, remembered, kinds, max_bytes))
+            if failure is not None:
+                kind, message = failure
+                raise MediaUnavailable(f"Skipped {url}, which failed recently: {message}", kind)
+        slot = self._host_slot(url)
+        if not slot.acquire(timeout=deadline.check("media fetch")):
+            raise DeadlineExceeded("Deadline exceeded waiting for a media fetch slot")
+        try:
+            response = self._get(url, deadline, headers)
+            try:
+                length = response.headers.get("Content-Length", "")
+                if length.isdigit() and int(length) > max_bytes:
+                    metrics.increment("media_fetch_too_large")
+                    raise MediaTooLarge(f"{url} is {length} bytes, over the {max_bytes} byte limit")
+                yield response
+            finally:
+                response.close()
+        except Exception as e:
+            kind = failure_kind(e)
+            # A timeout cut short by the request's own deadline isn't the server's fault
+            if kind is not None and not (kind == negative_cache.TIMEOUT and deadline.expired()):
+                negative_cache.record(failure_key(key, kind, kinds, max_bytes), kind, str(e))
+            raise
+        finally:
+            slot.release()
+
+    def iter_chunks(self, response, deadline, max_bytes):
+        """Yields the body in chunks, enforcing the byte cap and the deadline as it goes."""
+        received = 0
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            # The read timeout only bounds each socket read, so check the overall budget too
+            deadline.check("media download")
+            received += len(chunk)
+            if received > max_bytes:
+                metrics.increment("media_fetch_too_large")
+                raise MediaTooLarge(f"{response.url} is over the {max_bytes} byte limit")
+            yield chunk
+        metrics.increment("media_fetch_bytes", received)
+
+    def sniff_chunks(self, url, chunks, kinds):
+        """Checks the first bytes of a download against kinds before any more is read.
+
+        Returns the sniffed Media and the chunks with the ones already read put back in front.
+        """
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= media_sniff.SNIFF_BYTES:
+                break
+        # Leaving open() closes the response, so the rest of the body is never transferred
+        media = self.check_media(url, media_sniff.sniff(head), kinds)
+        return media, itertools.chain([head], chunks)
+
+    def check_media(self, url, media, kinds):
+        """Returns media if it's one of kinds, otherwise raises UnsupportedMedia."""
+        if media is None or media.kind not in kinds:
+            metrics.increment("media_fetch_unsupported")
+            found = media.format if media else "unrecognised data"
+            raise UnsupportedMedia(f"{url} is {found}, expected {' or '.join(kinds)}")
+        return media
+
+    def _cache_lookup(self, key):
+        return self.cache.lookup(key) if self.cache is not None else None
+
+    def _cache_hit(self, entry, response=None):
+        """Counts a cache hit: a fresh entry used as is, or a stale one the server confirmed with a 304."""
+        if response is None:
+            metrics.increment("media_cache_hits")
+        else:
+            self.cache.revalidated(entry, response.headers)
+            metrics.increment("media_cache_revalidated")
+        metrics.increment("media_cache_bytes_saved", entry.size)
+
+    def fetch_bytes(self, url, deadline=None, max_bytes=MAX_IMAGE_BYTES, kinds=None):
+        """Downloads url into memory; with kinds, aborts early unless it sniffs as one of them.
+
+        With a cache, a fresh copy is returned without a request and a stale one is revalidated.
+        Callers fetching the same asset (by canonical URL) at the same time share one download.
+        """
+        deadline = deadline or Deadline()
+        key = canonical_url.canonicalize(url)
+        # A waiter whose signed URL differs from the leader's gets its own try after an auth failure
+        return self._in_flight.do((key, kinds and tuple(kinds), max_bytes), deadline,
+                                  self._fetch_bytes, url, key, deadline, max_bytes, kinds, retry_if=is_auth_failure)
+
+    def _fetch_bytes(self, url, key, deadline, max_bytes, kinds):
+        entry = self._cache_lookup(key)
+        cached = self.cache.read(entry) if entry is not None else None
+        if cached is not None:
+            if kinds:
+                self.check_media(url, media_sniff.sniff(cached[:media_sniff.SNIFF_BYTES]), kinds)
+            if entry.expires > time.time():
+                self._cache_hit(entry)
+                return cached
+        with self.open(url, deadline, max_bytes, media_cache.validators(entry) if cached is not None else None,
+                       kinds) as response:
+            if response.status_code == 304 and cached is not None:
+                self._cache_hit(entry, response)
+                return cached
+            chunks = self.iter_chunks(response, deadline, max_bytes)
+            if kinds:
+                _, chunks = self.sniff_chunks(url, chunks, kinds)
+            data = b"".join(chunks)
+            if self.cache is not None:
+                self.cache.store(key, url, response.headers, data=data)
+            return data
+
+    def fetch_range(self, url, start, end, deadline=None, max_bytes=MAX_IMAGE_BYTES, kinds=None):
+        """Fetches bytes start..end-1 of url and returns (data, total_size).
+
+        If the server ignores the Range header or won't say how big the file is, the whole file
+        is returned with total_size None. kinds is checked against the body's first bytes.
+        """
+        deadline = deadline or Deadline()
+        with self.open(url, deadline, max_bytes, {"Range": f"bytes={start}-{end - 1}"}, kinds) as response:
+            chunks = self.iter_chunks(response, deadline, max_bytes)
+            if kinds and (start == 0 or response.status_code != 206):
+                _, chunks = self.sniff_chunks(url, chunks, kinds)
+            data = b"".join(chunks)
+            # Content-Range: bytes 0-65535/4718592, where the total may be "*"
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if response.status_code != 206:
+                return data, None
+        if not total.isdigit():
+            return self.fetch_bytes(url, deadline, max_bytes, kinds), None
+        return data, int(total)
+
+    def _checkout(self, url, entry, kinds):
+        """Puts the cached body for entry in a new temp file; returns (path, Media), or None if it's gone."""
+        try:
+            media = self.check_media(url, media_sniff.sniff_file(self.cache.path(entry)), kinds)
+        except FileNotFoundError:
+            return None
+        fd, path = tempfile.mkstemp(suffix=media.suffix)
+        os.close(fd)
+        if not self.cache.copy_to(entry, path):
+            os.remove(path)
+            return None
+        return path, media
+
+    def fetch_to_temp_file(self, url, deadline=None, max_bytes=MAX_VIDEO_BYTES, kinds=(media_sniff.VIDEO,)):
+        """Streams url into a new temp file named for its sniffed container; returns (path, Media).
+
+        Nothing is written to disk unless the first bytes are one of kinds. The caller removes the file.
+        With a cache, the file is a link to (or copy of) the cached body when that's fresh or revalidates.
+        """
+        deadline = deadline or Deadline()
+        key = canonical_url.canonicalize(url)
+        entry = self._cache_lookup(key)
+        cached = self._checkout(url, entry, kinds) if entry is not None else None
+        if cached is not None and entry.expires > time.time():
+            self._cache_hit(entry)
+            return cached
+        try:
+            with self.open(url, deadline, max_bytes, media_cache.validators(entry) if cached is not None else None,
+                           kinds) as response:
+                if response.status_code == 304 and cached is not None:
+                    self._cache_hit(entry, response)
+                    return cached
+                media, chunks = self.sniff_chunks(url, self.iter_chunks(response, deadline, max_bytes), kinds)
+                # The suffix is what tells the decoder (OpenCV/FFmpeg) which demuxer to try first
+                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=media.suffix)
+                try:
+                    with temp_file:
+                        for chunk in chunks:
+                            temp_file.write(chunk)
+                except BaseException:
+                    os.remove(temp_file.name)
+                    raise
+        except BaseException:
+            if cached is not None:
+                os.remove(cached[0])
+            raise
+        if cached is not None:
+            # Stale copy the server replaced
+            os.remove(cached[0])
+        if self.cache is not None:
+            self.cache.store(key, url, response.headers, path=temp_file.name)
+        return temp_file.name, media
+
+# Shared by every service module in the process
+fetcher = MediaFetcher(cache=media_cache.MediaCache() if media_cache.MEDIA_CACHE else None)
+fetch_bytes = fetcher.fetch_bytes
+fetch_range = fetcher.fetch_range
+fetch_to_temp_file = fetcher.fetch_to_temp_file
@@ -0,0 +1,62 @@
+from collections import namedtuple
+
+IMAGE, VIDEO = "image", "video"
+# Enough for every signature below, including the Matroska DocType
+SNIFF_BYTES = 64
+
+# What the leading bytes say a file is; suffix is the container hint handed to the decoder
+Media = namedtuple("Media", ["kind", "format", "suffix", "mime_type"])
+
+JPEG = Media(IMAGE, "jpeg", ".jpg", "image/jpeg")
+PNG = Media(IMAGE, "png", ".png", "image/png")
+GIF = Media(IMAGE, "gif", ".gif", "image/gif")
+WEBP = Media(IMAGE, "webp", ".webp", "image/webp")
+MP4 = Media(VIDEO, "mp4", ".mp4", "video/mp4")
+MOV = Media(VIDEO, "mov", ".mov", "video/quicktime")
+THREE_GP = Media(VIDEO, "3gp", ".3gp", "video/3gpp")
+WEBM = Media(VIDEO, "webm", ".webm", "video/webm")
+MKV = Media(VIDEO, "mkv", ".mkv", "video/x-matroska")
+AVI = Media(VIDEO, "avi", ".avi", "video/x-msvideo")
+FLV = Media(VIDEO, "flv", ".flv", "video/x-flv")
+
+# ISO base media "ftyp" brands that aren't plain MP4. Image brands (HEIC/AVIF) aren't supported.
+QUICKTIME_BRANDS = {b"qt  "}
+THREE_GP_BRANDS = {b"3gp4", b"3gp5", b"3gp6", b"3g2a"}
+IMAGE_BRANDS = {b"heic", b"heix", b"mif1", b"msf1", b"avif", b"avis"}
+# Old QuickTime files may start straight with one of these atoms instead of ftyp
+QUICKTIME_ATOMS = {b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"}
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+def sniff(head):
+    """Identifies media from its first SNIFF_BYTES bytes; returns a Media, or None if it isn't supported."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return JPEG
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return PNG
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return GIF
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return WEBP
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return AVI
+    if head[:3] == b"FLV":
+        return FLV
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in IMAGE_BRANDS:
+            return None
+        if brand in QUICKTIME_BRANDS:
+            return MOV
+        return THREE_GP if brand in THREE_GP_BRANDS else MP4
+    if head[4:8] in QUICKTIME_ATOMS:
+        return MOV
+    if head.startswith(EBML_MAGIC):
+        # The EBML header names the DocType; WebM is a Matroska profile
+        return WEBM if b"webm" in head[:SNIFF_BYTES] else MKV
+    return None
+
+
+def sniff_file(path):
+    with open(path, "rb") as file:
+        return sniff(file.read(SNIFF_BYTES))
@@ -0,0 +1,28 @@
+import threading
+
+# Process-wide counters and gauges, exposed as JSON by the services' /metrics routes
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def add_gauge(name, delta):
+    """Adds delta to a gauge and returns its new value."""
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + delta
+        return _gauges[name]
+
+
+def snapshot():
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
@@ -0,0 +1,155 @@
+import json
+import os
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import streaming
+import vertex_pool
+
+FAST, CAPABLE = "fast", "capable"
+
+# Category answers are short lists, so neither tier needs the old 8192-token ceiling. relative_cost
+# is a call's price in fast-tier calls (1.5 Pro lists at roughly 17x Flash per token).
+DEFAULT_TIERS = {
+    FAST: {
+        "model_name": "gemini-1.5-flash-001",
+        "generation_config": {"max_output_tokens": 256, "temperature": 0.2, "top_p": 0.95},
+        "relative_cost": 1.0,
+    },
+    CAPABLE: {
+        "model_name": "gemini-1.5-pro-001",
+        "generation_config": {"max_output_tokens": 512, "temperature": 0.2, "top_p": 0.95},
+        "relative_cost": 17.0,
+    },
+}
+TIERS = json.loads(os.environ["MODEL_ROUTING_TIERS"]) if os.environ.get("MODEL_ROUTING_TIERS") else DEFAULT_TIERS
+
+# Sub-tasks a post is split into, and how much caption text there is to go on
+CAPTION, IMAGE, VIDEO_FRAME, COMBINED = "caption", "image", "video_frame", "combined"
+SHORT_CAPTION_CHARS = int(os.environ.get("ROUTING_SHORT_CAPTION_CHARS", "40"))
+LONG_CAPTION_CHARS = int(os.environ.get("ROUTING_LONG_CAPTION_CHARS", "200"))
+
+# Starting rules: everything on the fast tier until shadowed calls show a bucket's fast answers
+# falling short of the capable tier's
+DEFAULT_RULES = {task: {"short": FAST, "medium": FAST, "long": FAST} for task in (CAPTION, IMAGE, VIDEO_FRAME, COMBINED)}
+
+# A fraction of calls also run on the other tier in the background to measure agreement
+SHADOW_SAMPLE_RATE = float(os.environ.get("ROUTING_SHADOW_SAMPLE_RATE", "0.02"))
+MIN_AGREEMENT_SAMPLES = int(os.environ.get("ROUTING_MIN_AGREEMENT_SAMPLES", "50"))
+AGREEMENT_TARGET = float(os.environ.get("ROUTING_AGREEMENT_TARGET", "0.8"))
+AGREEMENT_SMOOTHING = 0.05
+# Stream answers and parse categories as they arrive instead of waiting for the whole response
+STREAM_GENERATION = os.environ.get("STREAM_GENERATION", "1") == "1"
+# Don't start a capable-tier call with less time than this left on the request
+CAPABLE_MIN_BUDGET_SECONDS = float(os.environ.get("ROUTING_CAPABLE_MIN_BUDGET_SECONDS", "5"))
+# Most a routed call may cost on average, in fast-tier calls; capable-tier routing falls back to the
+# fast tier while the recent average is at or over it
+COST_BUDGET = float(os.environ.get("ROUTING_COST_BUDGET", "2.0"))
+COST_SMOOTHING = 0.01
+
+Route = namedtuple("Route", ["tier", "model_name", "generation_config", "bucket"])
+
+
+def caption_bucket(caption):
+    length = len(caption.strip())
+    if length < SHORT_CAPTION_CHARS:
+        return "short"
+    if length < LONG_CAPTION_CHARS:
+        return "medium"
+    return "long"
+
+
+def agreement(categories_a, categories_b):
+    """Jaccard overlap of two category lists, ignoring case and surrounding whitespace."""
+    a = {category.strip().lower() for category in categories_a if category.strip()}
+    b = {category.strip().lower() for category in categories_b if category.strip()}
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class ModelRouter:
+    """Picks a model tier and generation_config for each sub-task of a post."""
+
+    def __init__(self, system_instruction, tiers=None, rules=None, pool=None):
+        self.system_instruction = system_instruction
+        self.tiers = tiers or TIERS
+        self.rules = rules or DEFAULT_RULES
+        self.pool = pool or vertex_pool.pool
+        self._lock = threading.Lock()
+        # (task, caption bucket) -> (samples, smoothed fast/capable agreement)
+        self._agreement = {}
+        # Smoothed relative cost of recent routed calls
+        self._average_cost = self.tiers[FAST].get("relative_cost", 1.0)
+        self._shadow_executor = ThreadPoolExecutor(max_workers=2)
+
+    def model(self, model_name):
+        return self.pool.model(model_name, self.system_instruction)
+
+    def route(self, task, caption, deadline=None):
+        bucket = (task, caption_bucket(caption))
+        tier = self.rules[task][bucket[1]]
+        with self._lock:
+            samples, rate = self._agreement.get(bucket, (0, 0.0))
+            average_cost = self._average_cost
+        if samples >= MIN_AGREEMENT_SAMPLES:
+            # Only buckets where the fast tier measurably misses the capable tier's answer move up
+            tier = FAST if rate >= AGREEMENT_TARGET else CAPABLE
+        if tier == CAPABLE and deadline is not None and deadline.remaining() < CAPABLE_MIN_BUDGET_SECONDS:
+            tier = FAST
+        if tier == CAPABLE and average_cost >= COST_BUDGET:
+            metrics.increment("routing_capable_over_budget")
+            tier = FAST
+        metrics.increment(f"model_calls_routed_{tier}")
+        config = self.tiers[tier]
+        with self._lock:
+            self._average_cost += COST_SMOOTHING * (config.get("relative_cost", 1.0) - self._average_cost)
+            average_cost = self._average_cost
+        metrics.set_gauge("routing_average_cost", round(average_cost, 3))
+        return Route(tier, config["model_name"], config["generation_config"], bucket)
+
+    def generate(self, route, contents, deadline, on_category=None):
+        """Runs contents on the routed model under the deadline and returns the category list.
+
+        With streaming on, on_category is called for each category as soon as it is complete.
+        """
+        model = self.model(route.model_name)
+        if STREAM_GENERATION:
+            categories = deadline.call(self._stream, model, route, contents, deadline, on_category)
+        else:
+            response = deadline.call(model.generate_content, contents, generation_config=route.generation_config)
+            categories = response.text.strip().split(", ")
+            if on_category is not None:
+                for category in categories:
+                    on_category(category)
+        if random.random() < SHADOW_SAMPLE_RATE:
+            self._shadow_executor.submit(self._shadow, route, contents, categories)
+        return categories
+
+    def _stream(self, model, route, contents, deadline, on_category):
+        stream = model.generate_content(contents, generation_config=route.generation_config, stream=True)
+        return streaming.collect_categories(stream, on_category=on_category, deadline=deadline)
+
+    def _shadow(self, route, contents, categories):
+        other = self.tiers[CAPABLE if route.tier == FAST else FAST]
+        try:
+            response = self.model(other["model_name"]).generate_content(contents, generation_config=other["generation_config"])
+        except Exception:
+            metrics.increment("routing_shadow_errors")
+            return
+        self.record_agreement(route.bucket, agreement(categories, response.text.strip().split(", ")))
+
+    def record_agreement(self, bucket, value):
+        with self._lock:
+            samples, rate = self._agreement.get(bucket, (0, value))
+            rate += AGREEMENT_SMOOTHING * (value - rate)
+            self._agreement[bucket] = (samples + 1, rate)
+        metrics.set_gauge(f"routing_agreement_{bucket[0]}_{bucket[1]}", round(rate, 3))
+
+    def agreement_table(self):
+        with self._lock:
+            return {f"{task}/{bucket}": {"samples": samples, "agreement": round(rate, 3)}
+                    for (task, bucket), (samples, rate) in self._agreement.items()}
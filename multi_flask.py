@@ -1,12 +1,13 @@
 from flask import Flask, request, jsonify
 import base64
 import requests
-from io import BytesIO
-import PIL
-from PIL import Image
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
 import vertexai.preview.generative_models as generative_models
+from deadline import Deadline, DeadlineExceeded
+import categorize
+import partial_fetch
+import preprocess_pool
 
 app = Flask(__name__)
 
@@ -35,28 +36,33 @@ generation_config = {
     "top_p": 0.95,
 }
 
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
+model = categorize.regional_model(system_instruction)
 
-def fetch_and_preprocess_image(image_url):
+def fetch_and_preprocess_image(image_url, deadline=None):
     """Fetches the image from the URL, converts it to a format suitable for the model, and returns a Part object."""
-    response = requests.get(image_url)
-    image = Image.open(BytesIO(response.content))
-    image = image.resize((224, 224), PIL.Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
+    deadline = deadline or Deadline()
+    source = partial_fetch.fetch_image(image_url, deadline)
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
 
-def predict_categories(caption, image_urls):
+def predict_categories(caption, image_urls, deadline=None):
     """Combines one caption with multiple images into parts, calls the model, and returns the predicted categories."""
+    deadline = deadline or Deadline()
     contents = [Part.from_text(caption)]
     predicted_categories = []
-    for image_url in image_urls:
-        image_part = fetch_and_preprocess_image(image_url)
-        content = contents + [image_part]
-        response = model.generate_content(content, generation_config=generation_config)
-        predicted_categories.append(response.text.strip())
-    return predicted_categories
+    partial = False
+    try:
+        for image_url in image_urls:
+            image_part = fetch_and_preprocess_image(image_url, deadline)
+            content = contents + [image_part]
+            response = deadline.call(model.generate_content, content, generation_config=generation_config)
+            predicted_categories.append(response.text.strip())
+    except (DeadlineExceeded, requests.Timeout):
+        if not predicted_categories or not deadline.expired():
+            raise
+        # Out of time: answer with the images processed so far
+        partial = True
+    return predicted_categories, partial
 
 @app.route('/predict', methods=['POST'])
 def predict():
@@ -67,9 +73,12 @@ def predict():
     if not caption or not image_urls:
         return jsonify({"error": "Please provide a caption and at least one image URL."}), 400
 
+    deadline = Deadline.from_request(request)
     try:
-        predicted_categories = predict_categories(caption, image_urls)
-        return jsonify({"predicted_categories": predicted_categories})
+        predicted_categories, partial = predict_categories(caption, image_urls, deadline)
+        return jsonify({"predicted_categories": predicted_categories, "partial": partial})
+    except (DeadlineExceeded, requests.Timeout) as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
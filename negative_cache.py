@@ -0,0 +1,46 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+MAX_ENTRIES = int(os.environ.get("NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+
+NOT_FOUND, GONE, CLIENT_ERROR, SERVER_ERROR, DNS, CONNECTION, TIMEOUT, TOO_LARGE, UNSUPPORTED = (
+    "not_found", "gone", "client_error", "server_error", "dns", "connection", "timeout", "too_large", "unsupported")
+# How long each kind of failure is remembered: permanent-looking ones for minutes, ones that
+# may clear up by themselves for seconds. NEGATIVE_CACHE_<KIND>_SECONDS overrides; 0 disables.
+DEFAULT_TTL_SECONDS = {NOT_FOUND: 300, GONE: 3600, CLIENT_ERROR: 60, SERVER_ERROR: 15, DNS: 60,
+                       CONNECTION: 15, TIMEOUT: 10, TOO_LARGE: 3600, UNSUPPORTED: 3600}
+TTL_SECONDS = {kind: float(os.environ.get(f"NEGATIVE_CACHE_{kind.upper()}_SECONDS", str(seconds)))
+               for kind, seconds in DEFAULT_TTL_SECONDS.items()}
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+
+
+def get(key):
+    """Returns (kind, message) for a recent failure of key, or None."""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _entries[key]
+            return None
+    metrics.increment("negative_cache_hits")
+    metrics.increment(f"negative_cache_hits_{entry[1]}")
+    return entry[1], entry[2]
+
+
+def record(key, kind, message):
+    """Remembers that key just failed with kind, unless that kind's TTL is 0."""
+    if not TTL_SECONDS[kind]:
+        return
+    with _lock:
+        _entries[key] = (time.monotonic() + TTL_SECONDS[kind], kind, message)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+    metrics.increment(f"negative_cache_records_{kind}")
@@ -0,0 +1,150 @@
+import os
+import struct
+
+import canonical_url
+import media_fetch
+import metrics
+from deadline import Deadline
+from media_fetch import MAX_IMAGE_BYTES, MediaTooLarge
+from media_sniff import IMAGE
+from preprocess import TARGET_SIZE, decode_scale
+from single_flight import SingleFlight
+
+# Opt-in: fetch only the first scans of progressive JPEGs instead of the whole file
+PARTIAL_FETCH = os.environ.get("PARTIAL_JPEG_FETCH", "0") == "1"
+# Size of the first range request; each follow-up doubles what we have so far
+INITIAL_BYTES = int(os.environ.get("PARTIAL_JPEG_INITIAL_BYTES", str(128 * 1024)))
+
+SOI, EOI = b"\xff\xd8", b"\xff\xd9"
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+PROGRESSIVE_SOF_MARKERS = {0xC2, 0xC6, 0xCA, 0xCE}
+SOS = 0xDA
+# Markers with no length field: TEM and RST0-7 (SOI/EOI are handled separately)
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+# Highest zig-zag coefficient the luma channel needs at each decode scale: DC alone is an exact 1/8
+# scale image, the 2x2 lowest frequencies are enough at 1/4, 4x4 at 1/2, and full size needs them all
+REQUIRED_SPECTRAL_END = {8: 0, 4: 4, 2: 24, 1: 63}
+
+_in_flight = SingleFlight()
+
+
+class JpegLayout:
+    """What the markers in a (possibly truncated) JPEG say about its frame and which scans have fully arrived."""
+
+    def __init__(self):
+        self.size = None
+        self.progressive = False
+        self.component_ids = []
+        # (component ids, spectral start, spectral end, successive approximation high bit)
+        self.complete_scans = []
+
+
+def parse_layout(data):
+    """Walks the JPEG markers in data; returns None if it isn't a JPEG or the headers are broken."""
+    if not data.startswith(SOI):
+        return None
+    layout = JpegLayout()
+    position = 2
+    try:
+        while position + 4 <= len(data):
+            if data[position] != 0xFF:
+                return None
+            marker = data[position + 1]
+            if marker == 0xFF:
+                # Fill byte before a marker
+                position += 1
+                continue
+            if marker in STANDALONE_MARKERS:
+                position += 2
+                continue
+            if marker == EOI[1]:
+                break
+            length = struct.unpack(">H", data[position + 2:position + 4])[0]
+            segment = data[position + 4:position + 2 + length]
+            if len(segment) < length - 2:
+                # Header cut off by the end of the range
+                break
+            if marker in SOF_MARKERS:
+                height, width, count = struct.unpack(">HHB", segment[1:6])
+                layout.size = (width, height)
+                layout.progressive = marker in PROGRESSIVE_SOF_MARKERS
+                layout.component_ids = [segment[6 + 3 * index] for index in range(count)]
+            position += 2 + length
+            if marker != SOS:
+                continue
+            count = segment[0]
+            components = [segment[1 + 2 * index] for index in range(count)]
+            spectral_start, spectral_end, approximation = segment[1 + 2 * count:4 + 2 * count]
+            # Entropy-coded data runs to the next marker that isn't a stuffed 0xFF00 or a restart marker
+            end = position
+            while True:
+                end = data.find(b"\xff", end)
+                if end == -1 or end + 1 >= len(data):
+                    return layout
+                if data[end + 1] == 0x00 or data[end + 1] in STANDALONE_MARKERS:
+                    end += 2
+                    continue
+                break
+            layout.complete_scans.append((components, spectral_start, spectral_end, approximation >> 4))
+            position = end
+    except (struct.error, IndexError, ValueError):
+        return None
+    return layout
+
+
+def has_enough_detail(layout, target_size=TARGET_SIZE):
+    """True once every component's DC and the luma frequencies the decode scale needs have arrived."""
+    if layout is None or layout.size is None or not layout.progressive:
+        return False
+    first_pass = [scan for scan in layout.complete_scans if scan[3] == 0]
+    for component in layout.component_ids:
+        if not any(component in components and start == 0 for components, start, _, _ in first_pass):
+            return False
+    needed = REQUIRED_SPECTRAL_END[decode_scale(layout.size, target_size)]
+    luma = layout.component_ids[0]
+    covered = set()
+    for components, start, end, _ in first_pass:
+        if luma in components:
+            covered.update(range(start, end + 1))
+    return covered.issuperset(range(needed + 1))
+
+
+def fetch_image(url, deadline=None, target_size=TARGET_SIZE, max_bytes=MAX_IMAGE_BYTES):
+    """Fetches an image, stopping early once a progressive JPEG has enough scans for target_size.
+
+    Falls back to the whole file for baseline JPEGs, other formats and servers without Range support.
+    A truncated result ends with an EOI marker so the decoder treats the missing scans as empty.
+    """
+    if not PARTIAL_FETCH:
+        return media_fetch.fetch_bytes(url, deadline, max_bytes, kinds=(IMAGE,))
+    deadline = deadline or Deadline()
+    key = (canonical_url.canonicalize(url), target_size, max_bytes)
+    return _in_flight.do(key, deadline, _fetch_partial, url, deadline, target_size, max_bytes,
+                         retry_if=media_fetch.is_auth_failure)
+
+
+def _fetch_partial(url, deadline, target_size, max_bytes):
+    data, total = media_fetch.fetch_range(url, 0, INITIAL_BYTES, deadline, max_bytes, kinds=(IMAGE,))
+    if total is None:
+        return data
+    while len(data) < total:
+        layout = parse_layout(data)
+        if has_enough_detail(layout, target_size):
+            metrics.increment("partial_fetch_used")
+            metrics.increment("partial_fetch_bytes_saved", total - len(data))
+            return data + EOI
+        # Only progressive JPEGs get better with more scans; anything else needs the rest in one go
+        growing = layout is not None and (layout.progressive or layout.size is None)
+        end = min(total, len(data) * 2) if growing else total
+        if end > max_bytes:
+            raise MediaTooLarge(f"{url} is {total} bytes, over the {max_bytes} byte limit")
+        more, more_total = media_fetch.fetch_range(url, len(data), end, deadline, max_bytes)
+        if more_total is None:
+            # The server ignored this Range and sent the whole file
+            data = more
+            break
+        if not more:
+            break
+        data += more
+    metrics.increment("partial_fetch_full")
+    return data
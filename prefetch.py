@@ -0,0 +1,60 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from deadline import CANCEL_POLL_SECONDS
+
+# Downloads for all in-flight requests share this pool, so one big post can't open unbounded connections
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "16"))
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+
+class Prefetch:
+    """Runs a request's downloads in the background and hands them over in the order they finish."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self._futures = {}
+        # (key, error) for downloads completed() left out
+        self.skipped = []
+
+    def submit(self, key, fn, *args, cleanup=None):
+        """Starts fn(*args) in the background; cleanup(result) runs on close, even if the result was never used."""
+        future = _executor.submit(fn, *args)
+        self._futures[future] = (key, cleanup)
+        return future
+
+    def completed(self, skip=(), skip_in_time=()):
+        """Yields (key, result) as each download lands, stopping if the deadline passes or the request is cancelled.
+
+        Downloads that fail with one of the exception types in skip are left out and listed in skipped.
+        Those failing with one of skip_in_time are too, as long as the deadline hasn't passed; after
+        that the error is raised for the deadline handling.
+        """
+        pending = set(self._futures)
+        while pending:
+            self.deadline.check("media prefetch")
+            done, pending = wait(pending, timeout=min(self.deadline.remaining(), CANCEL_POLL_SECONDS),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                key = self._futures[future][0]
+                try:
+                    result = future.result()
+                except skip + skip_in_time as e:
+                    # Checked first: a ConnectTimeout is also a ConnectionError
+                    if isinstance(e, skip_in_time) and self.deadline.expired():
+                        raise
+                    self.skipped.append((key, e))
+                    continue
+                yield key, result
+
+    def close(self):
+        """Cancels downloads that haven't started and cleans up the results of the rest as they finish."""
+        for future, (_, cleanup) in self._futures.items():
+            future.cancel()
+            if cleanup is not None:
+                future.add_done_callback(lambda future, cleanup=cleanup: _cleanup(future, cleanup))
+
+
+def _cleanup(future, cleanup):
+    if not future.cancelled() and future.exception() is None:
+        cleanup(future.result())
@@ -0,0 +1,285 @@
+import os
+from collections import namedtuple
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import ExifTags, Image, ImageChops, ImageStat
+
+import metrics
+
+# Size of the image parts sent to the model
+TARGET_SIZE = (224, 224)
+# Largest image we'll open at all, and most pixels we'll hold decoded at once (RGB is 3 bytes each).
+# JPEGs over MAX_DECODE_PIXELS are fine if decoding at 1/2-1/8 scale brings them under it.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(250 * 1000 * 1000)))
+MAX_DECODE_PIXELS = int(os.environ.get("MAX_DECODE_PIXELS", str(40 * 1000 * 1000)))
+# Pillow's own bomb check as a backstop for any other Image.open: it warns past the limit and raises past twice it
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# How images and video frames are resized and re-encoded. With a reducing_gap, resize() first shrinks
+# the source by an integer factor (cheap box reduce) and only runs the filter over the last
+# reducing_gap times the target. "quality" is the default and the closest to the original services'
+# plain LANCZOS resize at PIL's default JPEG quality, but not byte-identical to it: JPEGs are
+# draft-decoded, its reducing_gap shortcuts the filter, and frames are resized before the BGR swap.
+# bench_presets.py measures every preset against that original pipeline.
+Preset = namedtuple("Preset", ["resample", "reducing_gap", "jpeg_quality"])
+PRESETS = {
+    "fast": Preset(Image.Resampling.BILINEAR, 1.5, 60),
+    "balanced": Preset(Image.Resampling.BICUBIC, 2.0, 70),
+    "quality": Preset(Image.Resampling.LANCZOS, 3.0, 75),
+}
+PRESET = os.environ.get("PREPROCESS_PRESET", "quality")
+# "pil", or "opencv" to decode with cv2.imdecode straight from the download buffer, resize with
+# INTER_AREA and encode with cv2.imencode, skipping PIL's copies of the payload
+BACKEND = os.environ.get("PREPROCESS_BACKEND", "pil")
+OPENCV_FORMATS = {"JPEG", "PNG", "WEBP", "BMP", "TIFF"}
+# PIL's decode ignores EXIF orientation, so the OpenCV path does too to give the model the same pixels
+OPENCV_READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                     4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# Opt-in: use a camera JPEG's embedded EXIF thumbnail (usually ~160px) instead of decoding the photo
+EXIF_THUMBNAIL = os.environ.get("EXIF_THUMBNAIL_SHORTCUT", "0") == "1"
+# Only worth it for big originals; smaller ones decode cheaply in draft mode at better quality
+EXIF_THUMBNAIL_MIN_PIXELS = int(os.environ.get("EXIF_THUMBNAIL_MIN_PIXELS", str(4000 * 1000)))
+EXIF_THUMBNAIL_MIN_SIDE = int(os.environ.get("EXIF_THUMBNAIL_MIN_SIDE", "120"))
+# Thumbnails whose width/height ratio is off by more than this are crops or letterboxed previews
+EXIF_THUMBNAIL_ASPECT_TOLERANCE = 0.03
+# Images already within TARGET_SIZE in one of these formats are forwarded untouched
+PASS_THROUGH = os.environ.get("PASS_THROUGH_SMALL_IMAGES", "1") == "1"
+PASS_THROUGH_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# A tiny image can still carry a large ICC profile or metadata block; re-encoding strips it
+PASS_THROUGH_MAX_BYTES = int(os.environ.get("PASS_THROUGH_MAX_BYTES", str(150 * 1024)))
+# Sampled animation frames whose tiny greyscale versions differ by less than this (mean, 0-255) from
+# one already kept are dropped as near-duplicates
+DEDUPE_THRESHOLD = float(os.environ.get("ANIMATION_DEDUPE_THRESHOLD", "6"))
+DEDUPE_SIZE = (16, 16)
+# IFD1 tags giving the thumbnail's offset (from the TIFF header) and length
+JPEG_INTERCHANGE_FORMAT, JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0201, 0x0202
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an image's header declares more pixels than we're willing to decode."""
+
+
+# What an image's header says about it, read before any pixels are decoded
+Probe = namedtuple("Probe", ["format", "width", "height", "frames", "decode_scale"])
+
+
+def decode_scale(size, target_size=TARGET_SIZE):
+    """The 1/N scale a JPEG can be decoded at and still cover target_size, as in JpegImageFile.draft."""
+    scale = min(size[0] // target_size[0], size[1] // target_size[1])
+    for candidate in (8, 4, 2, 1):
+        if scale >= candidate:
+            return candidate
+    return 1
+
+
+def open_header(source):
+    """Image.open, which only parses the header; pixels aren't decoded until load() or resize()."""
+    try:
+        return Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+    except Image.DecompressionBombError as e:
+        metrics.increment("images_rejected_too_large")
+        raise ImageTooLarge(str(e)) from e
+
+
+def probe_image(image, target_size=TARGET_SIZE):
+    """Checks an opened image's header against the pixel limits and returns a Probe, without decoding it."""
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        metrics.increment("images_rejected_too_large")
+        raise ImageTooLarge(f"{image.format} image is {width}x{height}, over the {MAX_IMAGE_PIXELS} pixel limit")
+    scale = decode_scale(image.size, target_size) if image.format == "JPEG" else 1
+    if (width // scale) * (height // scale) > MAX_DECODE_PIXELS:
+        metrics.increment("images_rejected_too_large")
+        raise ImageTooLarge(f"{image.format} image is {width}x{height}, too big to decode within {MAX_DECODE_PIXELS} pixels")
+    return Probe(image.format, width, height, getattr(image, "n_frames", 1), scale)
+
+
+def probe(source, target_size=TARGET_SIZE):
+    """Reads just the header of source (downloaded bytes, a path or a file-like object) and checks its limits."""
+    return probe_image(open_header(source), target_size)
+
+
+def draft(image, target_size=TARGET_SIZE):
+    """Lets the JPEG decoder decode straight at 1/2, 1/4 or 1/8 scale when that still covers target_size."""
+    if image.format == "JPEG":
+        # draft() picks the smallest DCT scale whose output is at least target_size in both dimensions
+        image.draft(image.mode, target_size)
+    return image
+
+
+def exif_thumbnail(image):
+    """Returns the decoded EXIF thumbnail of an opened JPEG if it can stand in for the full image, else None."""
+    raw = image.info.get("exif")
+    if not raw:
+        return None
+    try:
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(JPEG_INTERCHANGE_FORMAT), ifd1.get(JPEG_INTERCHANGE_FORMAT_LENGTH)
+        if offset is None or not length:
+            return None
+        # Offsets count from the TIFF header, which follows the "Exif\0\0" prefix
+        start = offset + 6 if raw.startswith(b"Exif\x00\x00") else offset
+        thumbnail = open_header(raw[start:start + length])
+        probe_image(thumbnail)
+        thumbnail.load()
+    except Exception:
+        # A broken thumbnail just means taking the normal path
+        return None
+    if min(thumbnail.size) < EXIF_THUMBNAIL_MIN_SIDE:
+        return None
+    main_ratio = image.width / image.height
+    if abs(thumbnail.width / thumbnail.height - main_ratio) > main_ratio * EXIF_THUMBNAIL_ASPECT_TOLERANCE:
+        return None
+    return thumbnail
+
+
+def pass_through_bytes(image, source, target_size=TARGET_SIZE):
+    """Returns source's raw bytes if its header says the model can take it as is, else None."""
+    if image.format not in PASS_THROUGH_MIME_TYPES or image.mode not in ("RGB", "L"):
+        return None
+    if image.width > target_size[0] or image.height > target_size[1] or getattr(image, "is_animated", False):
+        return None
+    if isinstance(source, bytes):
+        return source if len(source) <= PASS_THROUGH_MAX_BYTES else None
+    if isinstance(source, (str, os.PathLike)):
+        if os.path.getsize(source) > PASS_THROUGH_MAX_BYTES:
+            return None
+        with open(source, "rb") as file:
+            return file.read()
+    source.seek(0)
+    data = source.read(PASS_THROUGH_MAX_BYTES + 1)
+    return data if len(data) <= PASS_THROUGH_MAX_BYTES else None
+
+
+def get_preset(preset=None):
+    """Looks a preset up by name; None means the deployment's PREPROCESS_PRESET."""
+    return PRESETS[preset or PRESET]
+
+
+def source_buffer(source):
+    """A uint8 NumPy array over source's bytes, viewing downloaded bytes in place rather than copying them."""
+    if isinstance(source, bytes):
+        return np.frombuffer(source, np.uint8)
+    if isinstance(source, (str, os.PathLike)):
+        return np.fromfile(source, np.uint8)
+    if isinstance(source, BytesIO):
+        # getvalue() hands back the BytesIO's own bytes when nothing has been written to it
+        return np.frombuffer(source.getvalue(), np.uint8)
+    source.seek(0)
+    return np.frombuffer(source.read(), np.uint8)
+
+
+def opencv_resize_and_encode(array, target_size, preset):
+    array = cv2.resize(array, target_size, interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode(".jpg", array, [cv2.IMWRITE_JPEG_QUALITY, preset.jpeg_quality])
+    if not success:
+        raise ValueError("Failed to encode image")
+    return encoded.tobytes()
+
+
+def opencv_preprocess(source, image, target_size, preset):
+    """Decodes source with OpenCV (at reduced scale for JPEGs) and returns target_size JPEG bytes."""
+    scale = decode_scale(image.size, target_size) if image.format == "JPEG" else 1
+    array = cv2.imdecode(source_buffer(source), OPENCV_READ_FLAGS[scale] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if array is None:
+        raise ValueError(f"Failed to decode {image.format} image")
+    return opencv_resize_and_encode(array, target_size, preset)
+
+
+def resize(image, target_size, preset):
+    return image.resize(target_size, preset.resample, reducing_gap=preset.reducing_gap)
+
+
+def encode_jpeg(image, preset):
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=preset.jpeg_quality)
+    return buffer.getvalue()
+
+
+def preprocess_image(source, target_size=TARGET_SIZE, use_exif_thumbnail=None, preset=None, backend=None):
+    """Turns source (downloaded bytes, a path or a file-like object) into (mime_type, bytes) for the model.
+
+    Small images are passed through as they are; everything else is decoded at reduced scale
+    and re-encoded as a target_size JPEG.
+    """
+    image = open_header(source)
+    info = probe_image(image, target_size)
+    if info.width * info.height > MAX_DECODE_PIXELS:
+        metrics.increment("images_downscaled_at_decode")
+    if PASS_THROUGH:
+        data = pass_through_bytes(image, source, target_size)
+        if data is not None:
+            metrics.increment("image_pass_through")
+            return PASS_THROUGH_MIME_TYPES[image.format], data
+    preset = get_preset(preset)
+    if use_exif_thumbnail is None:
+        use_exif_thumbnail = EXIF_THUMBNAIL
+    # Checked before draft(), which shrinks the reported size
+    if use_exif_thumbnail and image.format == "JPEG" and image.width * image.height >= EXIF_THUMBNAIL_MIN_PIXELS:
+        thumbnail = exif_thumbnail(image)
+        if thumbnail is not None:
+            metrics.increment("exif_thumbnail_used")
+            return "image/jpeg", encode_jpeg(resize(thumbnail, target_size, preset), preset)
+        metrics.increment("exif_thumbnail_unusable")
+    if (backend or BACKEND) == "opencv" and image.format in OPENCV_FORMATS:
+        return "image/jpeg", opencv_preprocess(source, image, target_size, preset)
+    image = draft(image, target_size)
+    return "image/jpeg", encode_jpeg(resize(image, target_size, preset), preset)
+
+
+def preprocess_cascade(source, low_size, high_size, preset=None):
+    """Decodes source once and returns (mime_type, bytes) at low_size and at high_size.
+
+    The high-res one is None when the image is no bigger than low_size, since a second look would
+    show the model nothing new. Always goes through PIL; the EXIF thumbnail is too small for high_size.
+    """
+    image = open_header(source)
+    info = probe_image(image, high_size)
+    if max(info.width, info.height) <= max(low_size):
+        return preprocess_image(source, low_size, preset=preset), None
+    if info.width * info.height > MAX_DECODE_PIXELS:
+        metrics.increment("images_downscaled_at_decode")
+    preset = get_preset(preset)
+    high = resize(draft(image, high_size), high_size, preset)
+    # Shrinking the high-res version is cheaper than resizing the decoded original a second time
+    low = resize(high, low_size, preset)
+    return ("image/jpeg", encode_jpeg(low, preset)), ("image/jpeg", encode_jpeg(high, preset))
+
+
+def preprocess_frame(frame, target_size=TARGET_SIZE, preset=None, backend=None):
+    """Turns a BGR video frame, as read by cv2.VideoCapture, into target_size JPEG bytes."""
+    preset = get_preset(preset)
+    if (backend or BACKEND) == "opencv":
+        return opencv_resize_and_encode(frame, target_size, preset)
+    # Swap BGR to RGB after the resize, on 224x224 pixels rather than the whole frame
+    image = resize(Image.fromarray(frame), target_size, preset)
+    return encode_jpeg(Image.merge("RGB", image.split()[::-1]), preset)
+
+
+def sample_frame_indexes(frame_count, max_frames):
+    """Spreads up to max_frames samples evenly over frame_count frames, like the video frame interval."""
+    count = min(frame_count, max(0, max_frames))
+    return [index * frame_count // count for index in range(count)]
+
+
+def preprocess_animation(source, max_frames, target_size=TARGET_SIZE, preset=None):
+    """Samples an animated GIF/WebP/PNG in memory and returns its distinct frames as target_size JPEG bytes."""
+    image = open_header(source)
+    info = probe_image(image, target_size)
+    preset = get_preset(preset)
+    frames, signatures = [], []
+    for index in sample_frame_indexes(info.frames, max_frames):
+        image.seek(index)
+        frame = image.convert("RGB")
+        signature = frame.resize(DEDUPE_SIZE, Image.Resampling.BOX).convert("L")
+        if any(ImageStat.Stat(ImageChops.difference(signature, kept)).mean[0] < DEDUPE_THRESHOLD for kept in signatures):
+            metrics.increment("animation_frames_deduplicated")
+            continue
+        signatures.append(signature)
+        frames.append(encode_jpeg(resize(frame, target_size, preset), preset))
+    return frames
@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from deadline import Deadline
+import metrics
+import preprocess
+
+# Worker processes for decode/resize/encode, so CPU work isn't serialised on the GIL of a threaded
+# server. 0 keeps it on the calling thread; "auto" uses one per core.
+_processes = os.environ.get("PREPROCESS_PROCESSES", "0")
+PROCESSES = (os.cpu_count() or 1) if _processes == "auto" else int(_processes)
+# Payloads at least this big go through shared memory instead of being pickled down the pipe
+SHARED_MEMORY_MIN_BYTES = int(os.environ.get("PREPROCESS_SHARED_MEMORY_MIN_BYTES", str(256 * 1024)))
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _init_worker():
+    # One OpenCV thread per worker; the pool already spreads work across the cores
+    import cv2
+    cv2.setNumThreads(1)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn rather than fork: the services fork from a process full of threads and locks
+            _executor = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker)
+        return _executor
+
+
+def _reset_executor(broken):
+    global _executor
+    with _lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _share(data):
+    """Copies a bytes-like payload into a new shared memory block."""
+    view = memoryview(data).cast("B")
+    block = shared_memory.SharedMemory(create=True, size=max(1, view.nbytes))
+    block.buf[:view.nbytes] = view
+    return block
+
+
+def _counted(fn, *args):
+    """Runs fn in a worker and returns its result with the metrics counters it bumped there."""
+    before = metrics.snapshot()["counters"]
+    result = fn(*args)
+    after = metrics.snapshot()["counters"]
+    return result, {name: value - before.get(name, 0) for name, value in after.items() if value != before.get(name, 0)}
+
+
+def _read_shared(source, shared_name, size):
+    if shared_name is None:
+        return source
+    block = shared_memory.SharedMemory(name=shared_name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+
+
+def _image_worker(source, shared_name, size):
+    return _counted(preprocess.preprocess_image, _read_shared(source, shared_name, size))
+
+
+def _cascade_worker(source, shared_name, size, low_size, high_size):
+    return _counted(preprocess.preprocess_cascade, _read_shared(source, shared_name, size), low_size, high_size)
+
+
+def _animation_worker(source, shared_name, size, max_frames):
+    return _counted(preprocess.preprocess_animation, _read_shared(source, shared_name, size), max_frames)
+
+
+def _frame_worker(frame, shared_name, shape, dtype):
+    if shared_name is None:
+        return _counted(preprocess.preprocess_frame, frame)
+    block = shared_memory.SharedMemory(name=shared_name)
+    try:
+        frame = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        result = _counted(preprocess.preprocess_frame, frame)
+        # The view has to go before the block can be closed
+        del frame
+        return result
+    finally:
+        block.close()
+
+
+def _run(worker, args, block, deadline, stage):
+    """Submits worker(*args) to the pool and waits for it under the deadline, freeing block afterwards."""
+    executor = _get_executor()
+    try:
+        result, counters = deadline.wait(executor.submit(worker, *args), stage)
+    except BrokenProcessPool:
+        # A worker died (OOM, segfault in a decoder); start a fresh pool for the next call
+        _reset_executor(executor)
+        raise
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+    metrics.increment("preprocess_offloaded")
+    for name, value in counters.items():
+        metrics.increment(name, value)
+    return result
+
+
+def _source_args(source):
+    """Worker arguments for an image source, moving big payloads into shared memory; returns (args, block)."""
+    if isinstance(source, bytes) and len(source) >= SHARED_MEMORY_MIN_BYTES:
+        block = _share(source)
+        metrics.increment("preprocess_shared_memory")
+        return (None, block.name, len(source)), block
+    return (source, None, 0), None
+
+
+def preprocess_image(source, deadline=None):
+    """preprocess.preprocess_image on a worker process; returns (mime_type, bytes)."""
+    if not PROCESSES or not isinstance(source, (bytes, str)):
+        # Open file objects can't be sent to another process
+        return preprocess.preprocess_image(source)
+    args, block = _source_args(source)
+    return _run(_image_worker, args, block, deadline or Deadline(), "image preprocessing")
+
+
+def preprocess_cascade(source, low_size, high_size, deadline=None):
+    """preprocess.preprocess_cascade on a worker process; returns the low-res and high-res (mime_type, bytes)."""
+    if not PROCESSES or not isinstance(source, (bytes, str)):
+        return preprocess.preprocess_cascade(source, low_size, high_size)
+    args, block = _source_args(source)
+    return _run(_cascade_worker, args + (low_size, high_size), block, deadline or Deadline(), "image preprocessing")
+
+
+def preprocess_animation(source, max_frames, deadline=None):
+    """preprocess.preprocess_animation on a worker process; returns a list of JPEG bytes."""
+    if not PROCESSES or not isinstance(source, (bytes, str)):
+        return preprocess.preprocess_animation(source, max_frames)
+    args, block = _source_args(source)
+    return _run(_animation_worker, args + (max_frames,), block, deadline or Deadline(), "animation preprocessing")
+
+
+def preprocess_frame(frame, deadline=None):
+    """preprocess.preprocess_frame on a worker process; returns JPEG bytes."""
+    if not PROCESSES:
+        return preprocess.preprocess_frame(frame)
+    deadline = deadline or Deadline()
+    block = None
+    if frame.nbytes >= SHARED_MEMORY_MIN_BYTES:
+        block = _share(np.ascontiguousarray(frame))
+        metrics.increment("preprocess_shared_memory")
+        args = (None, block.name, frame.shape, frame.dtype.str)
+    else:
+        args = (frame, None, None, None)
+    return _run(_frame_worker, args, block, deadline, "frame preprocessing")
@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import canonical_url
+import metrics
+
+MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "10000"))
+TTL_SECONDS = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", "3600"))
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+
+
+def make_key(caption, image_paths=(), video_paths=()):
+    # Canonical URLs, so a repost through a fresh signed or tracked link still hits
+    return (caption.strip().lower(), tuple(map(canonical_url.canonicalize, image_paths)),
+            tuple(map(canonical_url.canonicalize, video_paths)))
+
+
+def get(key):
+    """Returns the cached categories for key, or None if missing or expired."""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            _entries.pop(key, None)
+            metrics.increment("result_cache_misses")
+            return None
+        _entries.move_to_end(key)
+    metrics.increment("result_cache_hits")
+    return list(entry[1])
+
+
+def put(key, categories):
+    with _lock:
+        _entries[key] = (time.monotonic() + TTL_SECONDS, list(categories))
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import Future
+
+from deadline import DeadlineExceeded, RequestCancelled
+import metrics
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers that arrive while it runs wait for it and share its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, deadline, fn, *args, retry_if=None):
+        """Returns fn(*args), or the result of the identical call already in flight for key.
+
+        A waiter whose shared call failed with an error for which retry_if(error) is true runs fn
+        itself, for errors that may only apply to the leader's arguments.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                # A running future can't be cancelled, so a waiter giving up doesn't take it from the others
+                future.set_running_or_notify_cancel()
+        if not leader:
+            metrics.increment("single_flight_shared")
+            try:
+                return deadline.wait(future, "shared media fetch")
+            except (DeadlineExceeded, RequestCancelled):
+                if not future.done():
+                    raise
+                # The call ran out of its own caller's time or was cancelled with it; this caller may have more
+                return fn(*args)
+            except Exception as e:
+                if retry_if is None or not retry_if(e):
+                    raise
+                metrics.increment("single_flight_retried")
+                return fn(*args)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+        future.set_result(result)
+        return result
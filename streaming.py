@@ -0,0 +1,90 @@
+import os
+
+import metrics
+
+# Stop reading a streamed answer once this many categories have arrived
+MAX_CATEGORIES = int(os.environ.get("STREAM_MAX_CATEGORIES", "10"))
+
+
+class CategoryStreamParser:
+    """Splits streamed model output into categories as each delimiter arrives.
+
+    Commas inside parentheses, as in "Collecting (e.g., stamps, coins)", don't end a category.
+    A line break after a category ends the answer, since the model is asked for one list.
+    """
+
+    def __init__(self, max_categories=MAX_CATEGORIES):
+        self.max_categories = max_categories
+        self.categories = []
+        self.done = False
+        self._buffer = ""
+        self._depth = 0
+
+    def feed(self, text):
+        """Consumes a chunk of output and returns the categories it completed."""
+        completed = []
+        for char in text:
+            if self.done:
+                break
+            if char == "(":
+                self._depth += 1
+            elif char == ")" and self._depth:
+                self._depth -= 1
+            if char == "," and not self._depth:
+                completed.extend(self._emit())
+            elif char == "\n" and not self._depth:
+                if self._buffer.strip():
+                    completed.extend(self._emit())
+                    self.done = True
+            else:
+                self._buffer += char
+        return completed
+
+    def finish(self):
+        """Flushes the last category once the stream has ended."""
+        return [] if self.done else self._emit()
+
+    def _emit(self):
+        category = self._buffer.strip()
+        self._buffer = ""
+        self._depth = 0
+        if not category:
+            return []
+        self.categories.append(category)
+        if len(self.categories) >= self.max_categories:
+            self.done = True
+        return [category]
+
+
+def chunk_text(chunk):
+    # Chunks without text (e.g. the final usage-only chunk) raise instead of returning ""
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ""
+
+
+def collect_categories(stream, max_categories=MAX_CATEGORIES, on_category=None, deadline=None):
+    """Reads a generate_content(stream=True) response, calling on_category as each category completes.
+
+    Reading stops at the terminal line break, at max_categories, or when the deadline is spent or
+    cancelled; the stream is closed so the server stops generating tokens nobody will read.
+    """
+    parser = CategoryStreamParser(max_categories)
+    try:
+        for chunk in stream:
+            for category in parser.feed(chunk_text(chunk)):
+                if on_category is not None:
+                    on_category(category)
+            if parser.done or (deadline is not None and (deadline.cancelled() or deadline.expired())):
+                metrics.increment("stream_early_stops")
+                break
+        else:
+            for category in parser.finish():
+                if on_category is not None:
+                    on_category(category)
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return parser.categories
@@ -0,0 +1,48 @@
+import pytest
+
+import canonical_url
+from canonical_url import canonicalize
+
+
+def test_query_order_does_not_matter():
+    assert canonicalize("https://cdn.example.com/a.jpg?w=640&h=480") == canonicalize("https://cdn.example.com/a.jpg?h=480&w=640")
+    assert canonicalize("https://cdn.example.com/a.jpg?w=640&h=480") == "https://cdn.example.com/a.jpg?h=480&w=640"
+
+
+def test_repeated_and_blank_parameters_are_kept():
+    assert canonicalize("https://cdn.example.com/a.jpg?b=2&a=&b=1") == "https://cdn.example.com/a.jpg?a=&b=1&b=2"
+
+
+def test_tracking_and_signing_parameters_are_dropped():
+    url = ("https://bucket.s3.amazonaws.com/a.mp4?X-Amz-Signature=abc&X-Amz-Expires=60&utm_source=feed"
+           "&fbclid=x&v=2")
+    assert canonicalize(url) == "https://bucket.s3.amazonaws.com/a.mp4?v=2"
+
+
+@pytest.mark.parametrize("url", [
+    "HTTPS://CDN.Example.com:443/a.jpg#top",
+    "https://cdn.example.com/a.jpg",
+    "https://cdn.example.com/a.jpg?",
+])
+def test_scheme_host_port_and_fragment(url):
+    assert canonicalize(url) == "https://cdn.example.com/a.jpg"
+
+
+def test_non_default_port_and_path_case_are_kept():
+    assert canonicalize("http://cdn.example.com:8080/A.jpg") == "http://cdn.example.com:8080/A.jpg"
+    assert canonicalize("http://[::1]:80/a.jpg") == "http://[::1]/a.jpg"
+
+
+@pytest.mark.parametrize("url", ["/tmp/a.jpg", "C:\\media\\a.jpg", "ftp://host/a.jpg", "http://host:notaport/a.jpg", "http:///a.jpg"])
+def test_anything_but_http_urls_is_returned_as_is(url):
+    assert canonicalize(url) == url
+
+
+def test_host_rule_applies_to_subdomains(monkeypatch):
+    monkeypatch.setattr(canonical_url, "rules", {
+        "example.com": canonical_url.make_rule({"size_params": ["w", "h"], "path": [["_\\d+x\\d+(?=\\.\\w+$)", ""]]}),
+        "img.example.net": canonical_url.make_rule({"keep": ["id"]}),
+    })
+    assert canonicalize("https://cdn.example.com/a_640x480.jpg?w=640&h=480&v=3") == "https://cdn.example.com/a.jpg?v=3"
+    assert canonicalize("https://img.example.net/get?size=large&id=7&v=3") == "https://img.example.net/get?id=7"
+    assert canonicalize("https://example.org/a_640x480.jpg?w=640") == "https://example.org/a_640x480.jpg?w=640"
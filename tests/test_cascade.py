@@ -0,0 +1,17 @@
+import cascade
+
+KNOWN = ["Photography", "Travel Photography", "Gaming"]
+
+
+def test_empty_response_escalates():
+    # A blank non-streamed response splits into [""]
+    assert cascade.escalation_reason([""], known_categories=KNOWN) == cascade.EMPTY
+    assert cascade.escalation_reason([], known_categories=KNOWN) == cascade.EMPTY
+
+
+def test_single_category_escalates():
+    assert cascade.escalation_reason(["Photography"], known_categories=KNOWN) == cascade.TOO_FEW
+
+
+def test_confident_answer_stands():
+    assert cascade.escalation_reason(["Photography", "Travel Photography"], ["Travel Photography"], KNOWN) is None
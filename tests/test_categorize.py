@@ -0,0 +1,34 @@
+import time
+
+import pytest
+import requests
+
+import categorize
+from deadline import Deadline, DeadlineExceeded
+
+
+def answers(error, deadline, wait_out=True):
+    """One model answer, then the request runs out of time (or a fetch times out early) on the next item."""
+    yield ["Photography"]
+    if wait_out:
+        time.sleep(max(0, deadline.remaining()))
+    raise error
+
+
+def test_out_of_time_returns_what_the_media_gave_so_far():
+    deadline = Deadline(0.05)
+    categories, partial = categorize.collect(answers(DeadlineExceeded("model call"), deadline), deadline, ["Travel"])
+    assert sorted(categories) == ["Photography", "Travel"]
+    assert partial
+
+
+def test_all_answers_in_is_not_partial():
+    categories, partial = categorize.collect(iter([["Photography"], ["Travel", "Photography"]]), Deadline(30))
+    assert sorted(categories) == ["Photography", "Travel"]
+    assert not partial
+
+
+def test_timeout_with_time_left_still_fails():
+    deadline = Deadline(30)
+    with pytest.raises(requests.Timeout):
+        categorize.collect(answers(requests.Timeout("slow"), deadline, wait_out=False), deadline)
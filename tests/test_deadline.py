@@ -0,0 +1,31 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import metrics
+from deadline import Deadline, DeadlineExceeded
+
+
+def abandoned():
+    return metrics.snapshot()["counters"].get("abandoned_calls", 0)
+
+
+def test_model_call_running_past_the_deadline_is_abandoned():
+    release = threading.Event()
+    before = abandoned()
+    with pytest.raises(DeadlineExceeded):
+        Deadline(0.2).call(release.wait, 5)
+    assert abandoned() == before + 1
+    release.set()
+
+
+def test_waiting_on_other_work_is_not_an_abandoned_call():
+    release = threading.Event()
+    before = abandoned()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(release.wait, 5)
+        with pytest.raises(DeadlineExceeded):
+            Deadline(0.2).wait(future)
+        release.set()
+    assert abandoned() == before
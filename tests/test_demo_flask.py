@@ -0,0 +1,125 @@
+import pytest
+import requests
+from PIL import Image
+
+import demo_flask
+import metrics
+import preprocess
+
+
+def test_oversized_image_is_skipped_not_fatal(tmp_path, monkeypatch):
+    paths = []
+    for name, size in (("small.jpg", (64, 48)), ("huge.png", (2000, 2000)), ("other.jpg", (48, 64))):
+        Image.new("RGB", size, "gray").save(tmp_path / name)
+        paths.append(str(tmp_path / name))
+    monkeypatch.setattr(preprocess, "MAX_IMAGE_PIXELS", 1000 * 1000)
+    calls = []
+
+    def generate(route, contents, deadline, on_category=None):
+        calls.append(contents)
+        return ["Photography"]
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+    skipped = metrics.snapshot()["counters"].get("media_items_skipped_on_fetch_error", 0)
+
+    response = demo_flask.app.test_client().post("/predict", json={"caption": "Weekend photos", "image_urls": paths})
+
+    assert response.status_code == 200
+    assert response.json["predicted_categories"] == ["Photography"]
+    # The caption and the two images that fit; the oversized one never reaches the model
+    assert len(calls) == 3
+    assert metrics.snapshot()["counters"]["media_items_skipped_on_fetch_error"] == skipped + 1
+
+
+def test_timed_out_item_is_skipped_while_time_is_left(tmp_path, monkeypatch):
+    Image.new("RGB", (64, 48), "gray").save(tmp_path / "small.jpg")
+    calls = []
+
+    def generate(route, contents, deadline, on_category=None):
+        calls.append(contents)
+        return ["Photography"]
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+
+    def download_image(image_path, deadline):
+        if image_path.startswith("http://"):
+            raise requests.ConnectTimeout(f"Timed out connecting to {image_path}")
+        return image_path
+
+    monkeypatch.setattr(demo_flask, "download_image", download_image)
+
+    response = demo_flask.app.test_client().post(
+        "/predict", json={"caption": "Weekend photos", "image_urls": [str(tmp_path / "small.jpg"), "http://example.invalid/a.jpg"]})
+
+    assert response.status_code == 200
+    assert response.json["predicted_categories"] == ["Photography"]
+    # The caption and the image that arrived
+    assert len(calls) == 2
+
+
+def test_saturated_workers_record_no_model_latency(monkeypatch):
+    def generate(route, contents, deadline, on_category=None):
+        raise demo_flask.WorkersSaturated("All model call threads are busy")
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+    monkeypatch.setattr(demo_flask.degradation.monitor, "model_latency", 2.0)
+
+    with pytest.raises(demo_flask.BackendUnavailable):
+        demo_flask.generate_categories([], demo_flask.Deadline())
+
+    assert demo_flask.degradation.monitor.model_latency == 2.0
+
+
+def test_model_call_past_the_deadline_counts_against_the_breaker(monkeypatch):
+    breaker = demo_flask.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    monkeypatch.setattr(demo_flask, "backend_breaker", breaker)
+
+    def generate(route, contents, deadline, on_category=None):
+        raise demo_flask.DeadlineExceeded("Deadline exceeded during model call")
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+
+    with pytest.raises(demo_flask.DeadlineExceeded):
+        demo_flask.generate_categories([], demo_flask.Deadline())
+    assert not breaker.allow_request()
+
+
+def test_cancelled_model_call_does_not_count_against_the_breaker(monkeypatch):
+    breaker = demo_flask.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    monkeypatch.setattr(demo_flask, "backend_breaker", breaker)
+
+    def generate(route, contents, deadline, on_category=None):
+        raise demo_flask.RequestCancelled("Request cancelled during model call")
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+
+    with pytest.raises(demo_flask.RequestCancelled):
+        demo_flask.generate_categories([], demo_flask.Deadline())
+    assert breaker.allow_request()
+
+
+def test_model_call_cut_short_cannot_lower_the_latency_average(monkeypatch):
+    def generate(route, contents, deadline, on_category=None):
+        raise demo_flask.RequestCancelled("Request cancelled during model call")
+
+    monkeypatch.setattr(demo_flask.router, "generate", generate)
+    monkeypatch.setattr(demo_flask.degradation.monitor, "model_latency", 2.0)
+
+    with pytest.raises(demo_flask.RequestCancelled):
+        demo_flask.generate_categories([], demo_flask.Deadline())
+
+    assert demo_flask.degradation.monitor.model_latency == 2.0
+
+
+def test_animated_image_frames_are_planned_as_model_calls(tmp_path):
+    frames = [Image.new("RGB", (64, 48), color) for color in ("black", "white", "red")]
+    frames[0].save(tmp_path / "moving.gif", save_all=True, append_images=frames[1:], duration=100)
+    progress = demo_flask.new_progress()
+
+    parts = demo_flask.preprocess_download("image", str(tmp_path / "moving.gif"), str(tmp_path / "moving.gif"),
+                                           demo_flask.Deadline(), 5, progress)
+
+    assert progress["extra_frames"] == len(parts) - 1 > 0
+    level = demo_flask.degradation.NORMAL
+    assert (demo_flask.planned_model_calls(["moving.gif"], [], level, progress["extra_frames"])
+            == demo_flask.planned_model_calls(["moving.gif"], [], level) + len(parts) - 1)
@@ -0,0 +1,21 @@
+from fallback import KeywordCategorizer, tokenize
+
+CATEGORIES = ["New Parents", "Celebrity News and Gossip", "Tech News and Reviews", "Smartphones and Mobile Devices",
+              "Dog Owners", "Fitness and Bodybuilding"]
+
+
+def test_stemming_keeps_words_that_are_not_plurals():
+    assert tokenize("news fitness campus tennis") == ["news", "fitness", "campus", "tennis"]
+    assert tokenize("dogs reviews") == ["dog", "review"]
+
+
+def test_new_does_not_match_new_parents_or_news():
+    categories = KeywordCategorizer(CATEGORIES).categorize("New phone unboxing")
+    assert "New Parents" not in categories
+    assert not [category for category in categories if "News" in category]
+
+
+def test_news_still_matches_news_categories():
+    categories = KeywordCategorizer(CATEGORIES).categorize("Today's tech news")
+    assert categories[0] == "Tech News and Reviews"
+    assert "New Parents" not in categories
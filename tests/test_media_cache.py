@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import media_cache
+
+HEADERS = {"ETag": '"v1"'}
+BODY = b"x" * 1000
+
+
+def count_scans(cache):
+    scans = []
+    usage = cache._usage
+    cache._usage = lambda: scans.append(1) or usage()
+    return scans
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_cache, "RESCAN_SECONDS", 3600)
+    return media_cache.MediaCache(str(tmp_path), max_bytes=4500)
+
+
+def test_stores_under_the_bound_do_not_scan_the_directory(cache):
+    scans = count_scans(cache)
+    for index in range(4):
+        cache.store(f"key{index}", "url", HEADERS, data=BODY)
+    cache.revalidated(cache.lookup("key0"), HEADERS)
+    assert scans == []
+    assert all(cache.lookup(f"key{index}") is not None for index in range(4))
+
+
+def test_going_over_the_bound_scans_and_evicts_the_oldest(cache):
+    for index in range(4):
+        cache.store(f"key{index}", "url", HEADERS, data=BODY)
+        os.utime(cache._path(f"key{index}"), (index, index))
+    scans = count_scans(cache)
+    cache.store("key4", "url", HEADERS, data=BODY)
+    assert len(scans) == 1
+    assert cache.lookup("key0") is None
+    assert all(cache.lookup(f"key{index}") is not None for index in range(1, 5))
+    # Back under the bound, so the next store doesn't scan again
+    cache.store("key1", "url", HEADERS, data=b"y" * 100)
+    assert len(scans) == 1
+
+
+def test_other_processes_stores_are_seen_on_the_rescan_timer(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_cache, "RESCAN_SECONDS", 3600)
+    ours = media_cache.MediaCache(str(tmp_path), max_bytes=4500)
+    theirs = media_cache.MediaCache(str(tmp_path), max_bytes=4500)
+    for index in range(3):
+        theirs.store(f"theirs{index}", "url", HEADERS, data=BODY)
+        os.utime(theirs._path(f"theirs{index}"), (index, index))
+    for index in range(2):
+        ours.store(f"ours{index}", "url", HEADERS, data=BODY)
+    # Neither process has stored enough on its own to look over the bound
+    assert ours.lookup("theirs0") is not None
+    monkeypatch.setattr(media_cache, "RESCAN_SECONDS", 0)
+    ours.revalidated(ours.lookup("ours0"), HEADERS)
+    assert ours.lookup("theirs0") is None
+    assert ours.lookup("ours1") is not None
@@ -0,0 +1,54 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import media_fetch
+from media_sniff import IMAGE, MP4
+
+MP4_BODY = b"\x00\x00\x00\x18ftypisom" + b"\x00" * 500
+
+
+@pytest.fixture
+def mp4_url():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(len(MP4_BODY)))
+            self.end_headers()
+            self.wfile.write(MP4_BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/clip.mp4"
+    server.shutdown()
+    server.server_close()
+
+
+def fetch_video(url):
+    path, media = media_fetch.MediaFetcher().fetch_to_temp_file(url)
+    os.remove(path)
+    return media
+
+
+def test_wrong_kind_is_only_remembered_for_that_kind(mp4_url):
+    fetcher = media_fetch.MediaFetcher()
+    with pytest.raises(media_fetch.UnsupportedMedia):
+        fetcher.fetch_bytes(mp4_url, kinds=(IMAGE,))
+    with pytest.raises(media_fetch.MediaUnavailable):
+        fetcher.fetch_bytes(mp4_url, kinds=(IMAGE,))
+    assert fetch_video(mp4_url) == MP4
+
+
+def test_too_large_is_only_remembered_for_that_cap(mp4_url):
+    fetcher = media_fetch.MediaFetcher()
+    with pytest.raises(media_fetch.MediaTooLarge):
+        fetcher.fetch_bytes(mp4_url, max_bytes=100)
+    assert fetch_video(mp4_url) == MP4
@@ -0,0 +1,59 @@
+import pytest
+
+import media_sniff
+from media_sniff import sniff
+
+MP4_HEAD = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2mp41"
+WEBM_HEAD = b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\xf7\x81\x01\x42\xf2\x81\x04\x42\xf3\x81\x08\x42\x82\x84webm"
+
+
+@pytest.mark.parametrize("head, media", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00", media_sniff.JPEG),
+    (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR", media_sniff.PNG),
+    (b"GIF89a\x01\x00\x01\x00", media_sniff.GIF),
+    (b"RIFF\x24\x00\x00\x00WEBPVP8 ", media_sniff.WEBP),
+    (b"RIFF\x24\x00\x00\x00AVI LIST", media_sniff.AVI),
+    (b"FLV\x01\x05\x00\x00\x00\x09", media_sniff.FLV),
+    (MP4_HEAD, media_sniff.MP4),
+    (b"\x00\x00\x00\x14ftypqt  \x00\x00\x02\x00", media_sniff.MOV),
+    (b"\x00\x00\x00\x18ftyp3gp5\x00\x00\x00\x00", media_sniff.THREE_GP),
+    (b"\x00\x00\x00\x08wide\x00\x00\x00\x00mdat", media_sniff.MOV),
+    (WEBM_HEAD, media_sniff.WEBM),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\x82\x88matroska", media_sniff.MKV),
+])
+def test_signatures(head, media):
+    assert sniff(head) == media
+
+
+@pytest.mark.parametrize("head", [
+    b"",
+    b"\xff",
+    b"\xff\xd8",
+    b"\x89PNG",
+    b"GIF8",
+    b"RIFF",
+    b"RIFF\x24\x00\x00\x00",
+    b"FL",
+    b"\x00\x00\x00\x18",
+    b"\x1a\x45\xdf",
+])
+def test_headers_too_short_to_tell_are_unsupported(head):
+    assert sniff(head) is None
+
+
+def test_short_headers_never_raise():
+    for head in (MP4_HEAD, WEBM_HEAD, b"\xff\xd8\xff\xe0"):
+        for end in range(len(head) + 1):
+            sniff(head[:end])
+
+
+def test_image_brands_and_unknown_data_are_unsupported():
+    assert sniff(b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic") is None
+    assert sniff(b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00avifmif1") is None
+    assert sniff(b"<!DOCTYPE html><html>") is None
+
+
+def test_sniff_file_reads_only_the_head(tmp_path):
+    path = tmp_path / "clip.bin"
+    path.write_bytes(MP4_HEAD + b"\x00" * 1000)
+    assert media_sniff.sniff_file(path) == media_sniff.MP4
@@ -0,0 +1,30 @@
+import model_routing
+from model_routing import CAPABLE, FAST, IMAGE, ModelRouter
+
+
+def learn(router, bucket, value):
+    for _ in range(model_routing.MIN_AGREEMENT_SAMPLES):
+        router.record_agreement(bucket, value)
+
+
+def test_every_bucket_starts_on_the_fast_tier():
+    router = ModelRouter("", pool=object())
+    for task, buckets in model_routing.DEFAULT_RULES.items():
+        for caption in ("hi", "x" * model_routing.SHORT_CAPTION_CHARS, "x" * model_routing.LONG_CAPTION_CHARS):
+            assert router.route(task, caption).tier == FAST
+
+
+def test_low_agreement_moves_a_bucket_to_the_capable_tier():
+    router = ModelRouter("", pool=object())
+    learn(router, (IMAGE, "short"), 0.2)
+    assert router.route(IMAGE, "hi").tier == CAPABLE
+    assert router.route(IMAGE, "x" * model_routing.SHORT_CAPTION_CHARS).tier == FAST
+
+
+def test_cost_budget_caps_capable_routing(monkeypatch):
+    monkeypatch.setattr(model_routing, "COST_BUDGET", 1.5)
+    router = ModelRouter("", pool=object())
+    learn(router, (IMAGE, "short"), 0.2)
+    tiers = [router.route(IMAGE, "hi").tier for _ in range(200)]
+    assert CAPABLE in tiers and FAST in tiers
+    assert tiers.count(CAPABLE) < 20
@@ -0,0 +1,119 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import partial_fetch
+
+
+def make_jpeg(size=256, **options):
+    pixels = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90, **options)
+    return buffer.getvalue()
+
+
+def scan_starts(data):
+    """Offsets of each SOS marker; entropy-coded data stuffs 0xFF bytes, so the pattern can't occur inside it."""
+    starts, position = [], data.find(b"\xff\xda")
+    while position != -1:
+        starts.append(position)
+        position = data.find(b"\xff\xda", position + 2)
+    return starts
+
+
+@pytest.fixture
+def first_range_only_server():
+    """Serves one JPEG, answering the first Range request with a 206 and every later one with the whole file."""
+    body = make_jpeg()
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requests_seen.append(self.headers.get("Range"))
+            data = body
+            if self.headers.get("Range") and len(requests_seen) == 1:
+                start, _, end = self.headers["Range"][len("bytes="):].partition("-")
+                data = body[int(start):int(end) + 1]
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{int(start) + len(data) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/photo.jpg", body, requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_follow_up_range_answered_with_whole_file(first_range_only_server, monkeypatch):
+    url, body, requests_seen = first_range_only_server
+    monkeypatch.setattr(partial_fetch, "PARTIAL_FETCH", True)
+    monkeypatch.setattr(partial_fetch, "INITIAL_BYTES", 1024)
+
+    assert partial_fetch.fetch_image(url) == body
+    assert len(requests_seen) == 2
+
+
+def test_layout_of_a_whole_progressive_jpeg():
+    data = make_jpeg(2048, progressive=True)
+    layout = partial_fetch.parse_layout(data)
+    assert layout.size == (2048, 2048)
+    assert layout.progressive
+    assert len(layout.component_ids) == 3
+    assert len(layout.complete_scans) == len(scan_starts(data))
+    assert partial_fetch.has_enough_detail(layout)
+
+
+def test_truncated_frame_header_has_no_size():
+    data = make_jpeg(2048, progressive=True)
+    sof = data.find(b"\xff\xc2")
+    for end in (sof + 3, sof + 6, sof + 12):
+        layout = partial_fetch.parse_layout(data[:end])
+        assert layout.size is None
+        assert not partial_fetch.has_enough_detail(layout)
+
+
+def test_truncated_first_scan_is_not_enough():
+    data = make_jpeg(2048, progressive=True)
+    first, second = scan_starts(data)[:2]
+    # Cut inside the scan header, then inside its entropy-coded data
+    for end in (first + 5, (first + second) // 2):
+        layout = partial_fetch.parse_layout(data[:end])
+        assert layout.size == (2048, 2048)
+        assert layout.complete_scans == []
+        assert not partial_fetch.has_enough_detail(layout)
+
+
+def test_dc_scan_is_enough_at_an_eighth_scale():
+    data = make_jpeg(2048, progressive=True)
+    second = scan_starts(data)[1]
+    layout = partial_fetch.parse_layout(data[:second + 2])
+    assert len(layout.complete_scans) == 1
+    assert partial_fetch.has_enough_detail(layout)
+
+
+def test_full_scale_needs_every_luma_frequency():
+    data = make_jpeg(224, progressive=True)
+    starts = scan_starts(data)
+    assert not partial_fetch.has_enough_detail(partial_fetch.parse_layout(data[:starts[1] + 2]))
+    assert partial_fetch.has_enough_detail(partial_fetch.parse_layout(data))
+
+
+def test_baseline_and_non_jpeg_data():
+    assert not partial_fetch.has_enough_detail(partial_fetch.parse_layout(make_jpeg()))
+    assert partial_fetch.parse_layout(b"\x89PNG\r\n\x1a\n") is None
+    assert partial_fetch.parse_layout(b"\xff\xd8\x00\x00\x00\x00") is None
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import media_fetch
+from deadline import Deadline
+from single_flight import SingleFlight
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+def run_with_waiter(leader_fn, waiter_fn, retry_if=None):
+    """Starts leader_fn under a key, then a waiter with waiter_fn under the same key; returns what the waiter got."""
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def leader():
+        started.set()
+        time.sleep(0.2)
+        return leader_fn()
+
+    def lead():
+        try:
+            flight.do("key", Deadline(), leader)
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    started.wait()
+    try:
+        return flight.do("key", Deadline(), waiter_fn, retry_if=retry_if)
+    finally:
+        thread.join()
+
+
+def fail(error):
+    def fn():
+        raise error
+    return fn
+
+
+def test_waiter_retries_its_own_url_after_an_auth_failure():
+    result = run_with_waiter(fail(http_error(403)), lambda: b"data", retry_if=media_fetch.is_auth_failure)
+    assert result == b"data"
+
+
+def test_waiter_shares_other_failures():
+    with pytest.raises(requests.HTTPError):
+        run_with_waiter(fail(http_error(404)), lambda: b"data", retry_if=media_fetch.is_auth_failure)
+
+
+def test_waiter_shares_the_result():
+    assert run_with_waiter(lambda: b"shared", lambda: b"own") == b"shared"
@@ -0,0 +1,41 @@
+from streaming import CategoryStreamParser
+
+ANSWER = "Photography, Collecting (e.g., stamps, coins), Travel Photography"
+CATEGORIES = ["Photography", "Collecting (e.g., stamps, coins)", "Travel Photography"]
+
+
+def parse(chunks, max_categories=10):
+    parser = CategoryStreamParser(max_categories)
+    completed = [parser.feed(chunk) for chunk in chunks]
+    return completed, parser.finish(), parser
+
+
+def test_categories_split_across_chunks():
+    completed, last, _ = parse(["Photo", "graphy, Coll", "ecting (e.g., st", "amps, coins), Trav", "el Photography"])
+    assert completed == [[], ["Photography"], [], ["Collecting (e.g., stamps, coins)"], []]
+    assert last == ["Travel Photography"]
+
+
+def test_any_chunking_gives_the_same_categories():
+    for size in (1, 2, 3, 7, len(ANSWER)):
+        _, _, parser = parse([ANSWER[i:i + size] for i in range(0, len(ANSWER), size)])
+        assert parser.categories == CATEGORIES
+
+
+def test_line_break_ends_the_answer():
+    completed, last, parser = parse(["Photography, Travel\n", "Here is why: cameras, maps"])
+    assert completed == [["Photography", "Travel"], []]
+    assert last == []
+    assert parser.done
+
+
+def test_stops_at_max_categories():
+    completed, last, parser = parse(["A, B, C, D"], max_categories=2)
+    assert completed == [["A", "B"]]
+    assert last == []
+    assert parser.categories == ["A", "B"]
+
+
+def test_empty_items_are_dropped():
+    _, _, parser = parse(["\n, A,, B, "])
+    assert parser.categories == ["A", "B"]
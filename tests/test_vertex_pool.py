@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import vertex_pool
+from circuit_breaker import CLOSED, OPEN
+from vertex_pool import EndpointPool, NoHealthyRegion
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Stands in for a regional GenerativeModel; failing regions raise their error from every call."""
+
+    def __init__(self, region, errors, calls, hang=None):
+        self.region = region
+        self.errors = errors
+        self.calls = calls
+        self.hang = hang
+
+    def generate_content(self, contents, **kwargs):
+        self.calls.append(self.region)
+        if self.region in self.errors:
+            raise self.errors[self.region]
+        return FakeResponse(self.region)
+
+    def count_tokens(self, text):
+        if self.hang is not None:
+            self.hang.wait(5)
+        if self.region in self.errors:
+            raise self.errors[self.region]
+
+
+@pytest.fixture(autouse=True)
+def no_exploration(monkeypatch):
+    monkeypatch.setattr(vertex_pool, "EXPLORE_RATE", 0.0)
+
+
+def make_pool(errors, calls, quotas_rpm=None, hang=None):
+    return EndpointPool(regions=["region-a", "region-b"], quotas_rpm=quotas_rpm or {}, probe_interval=0,
+                        model_factory=lambda region, model_name, system_instruction: FakeModel(region, errors, calls, hang))
+
+
+def generate(pool):
+    return pool.generate_content("model", "instruction", ["hello"]).text
+
+
+def test_fails_over_to_the_next_region():
+    calls = []
+    pool = make_pool({"region-a": google_exceptions.ServiceUnavailable("down")}, calls)
+    assert generate(pool) == "region-b"
+    assert calls == ["region-a", "region-b"]
+
+
+def test_bad_request_does_not_fail_over():
+    calls = []
+    pool = make_pool({"region-a": google_exceptions.InvalidArgument("bad image")}, calls)
+    with pytest.raises(google_exceptions.InvalidArgument):
+        generate(pool)
+    assert calls == ["region-a"]
+
+
+def test_failing_region_is_ejected_once_its_breaker_opens():
+    calls = []
+    down = google_exceptions.ServiceUnavailable("down")
+    errors = {"region-a": down, "region-b": down}
+    pool = make_pool(errors, calls)
+    for _ in range(vertex_pool.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(NoHealthyRegion):
+            generate(pool)
+    assert pool.endpoints[0].breaker.state == OPEN
+    del errors["region-b"]
+    pool.endpoints[1].breaker.record_success()
+    calls.clear()
+    assert generate(pool) == "region-b"
+    assert calls == ["region-b"]
+
+
+def test_no_healthy_region():
+    errors = {region: google_exceptions.ServiceUnavailable("down") for region in ("region-a", "region-b")}
+    with pytest.raises(NoHealthyRegion):
+        generate(make_pool(errors, []))
+
+
+def test_region_short_of_quota_is_used_last():
+    calls = []
+    pool = make_pool({}, calls, quotas_rpm={"region-a": 1})
+    assert [generate(pool) for _ in range(3)] == ["region-a", "region-b", "region-b"]
+
+
+def test_quota_exhausted_region_is_used_last():
+    calls = []
+    errors = {"region-a": google_exceptions.ResourceExhausted("quota")}
+    pool = make_pool(errors, calls)
+    generate(pool)
+    errors.clear()
+    calls.clear()
+    assert generate(pool) == "region-b"
+    assert calls == ["region-b"]
+
+
+def open_region_a(pool):
+    generate(pool)
+    endpoint = pool.endpoints[0]
+    for _ in range(vertex_pool.BREAKER_FAILURE_THRESHOLD):
+        endpoint.breaker.record_failure()
+    # Cool-down over: the region is half open and waiting for a probe
+    endpoint.breaker.reset_timeout = 0
+    return endpoint
+
+
+def test_probe_recovers_a_region():
+    pool = make_pool({}, [])
+    endpoint = open_region_a(pool)
+    pool.probe()
+    assert endpoint.breaker.state == CLOSED
+
+
+def test_hung_probe_times_out(monkeypatch):
+    monkeypatch.setattr(vertex_pool, "PROBE_TIMEOUT_SECONDS", 0.2)
+    hang = threading.Event()
+    pool = make_pool({}, [], hang=hang)
+    endpoint = open_region_a(pool)
+    start = time.monotonic()
+    pool.probe()
+    hang.set()
+    assert time.monotonic() - start < 2
+    endpoint.breaker.reset_timeout = 30
+    assert endpoint.breaker.state == OPEN
@@ -0,0 +1,58 @@
+import math
+import os
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import metrics
+import preprocess
+
+# Opt-in: send a post's image thumbnails, and each video's sampled frames, as one labeled grid image
+# per model call instead of one call per thumbnail
+TILING = os.environ.get("TILE_MEDIA", "0") == "1"
+# Longest side of a grid; tiles shrink below the preprocessing size to fit, but never grow past it
+GRID_SIZE = int(os.environ.get("TILE_GRID_SIZE", "672"))
+# Beyond this many thumbnails a post gets several grids, so the tiles stay big enough to read
+MAX_TILES = int(os.environ.get("TILE_MAX_PER_GRID", "9"))
+LABEL_PADDING = 2
+
+
+def grid_shape(count):
+    """(columns, rows) of the most nearly square grid that holds count tiles."""
+    columns = math.ceil(math.sqrt(count))
+    return columns, math.ceil(count / columns)
+
+
+def compose_grid(thumbnails, grid_size=GRID_SIZE, preset=None):
+    """Lays encoded thumbnails out left to right, top to bottom, labeled 1, 2, ...; returns JPEG bytes."""
+    preset = preprocess.get_preset(preset)
+    columns, rows = grid_shape(len(thumbnails))
+    tile = min(grid_size // columns, *preprocess.TARGET_SIZE)
+    canvas = Image.new("RGB", (columns * tile, rows * tile), "white")
+    draw = ImageDraw.Draw(canvas)
+    for index, data in enumerate(thumbnails):
+        x, y = index % columns * tile, index // columns * tile
+        with Image.open(BytesIO(data)) as image:
+            image = image.convert("RGB")
+            image.thumbnail((tile, tile), preset.resample)
+        canvas.paste(image, (x + (tile - image.width) // 2, y + (tile - image.height) // 2))
+        label = str(index + 1)
+        origin = (x + 2 * LABEL_PADDING, y + 2 * LABEL_PADDING)
+        left, top, right, bottom = draw.textbbox(origin, label)
+        draw.rectangle((left - LABEL_PADDING, top - LABEL_PADDING, right + LABEL_PADDING, bottom + LABEL_PADDING), fill="black")
+        draw.text(origin, label, fill="white")
+    metrics.increment("tiling_grids")
+    metrics.increment("tiling_thumbnails", len(thumbnails))
+    return preprocess.encode_jpeg(canvas, preset)
+
+
+def tile(thumbnails, grid_size=GRID_SIZE, max_tiles=MAX_TILES, preset=None):
+    """Splits thumbnails into grids of at most max_tiles; returns a list of (JPEG bytes, tile count)."""
+    groups = [thumbnails[start:start + max_tiles] for start in range(0, len(thumbnails), max_tiles)]
+    return [(compose_grid(group, grid_size, preset), len(group)) for group in groups]
+
+
+def describe(count):
+    """Text sent just before a grid so the model reads it as separate pictures rather than one scene."""
+    return (f"The next image is a grid of {count} numbered pictures from this post. "
+            "Categorize the pictures, not the grid layout.")
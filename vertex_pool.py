@@ -0,0 +1,328 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+from google.api_core import exceptions as google_exceptions
+from vertexai.generative_models import GenerativeModel
+from google.cloud.aiplatform import initializer as aiplatform_initializer
+
+import deadline
+import metrics
+from client_pool import ClientPool
+from circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+
+# Regions to spread traffic over, and optional per-region requests-per-minute quotas ("region=rpm,...")
+REGIONS = [region.strip() for region in os.environ.get("VERTEX_REGIONS", "us-central1,us-east4,us-west1").split(",") if region.strip()]
+REGION_QUOTAS_RPM = dict(
+    (item.split("=")[0].strip(), int(item.split("=")[1]))
+    for item in os.environ.get("VERTEX_REGION_QUOTAS_RPM", "").split(",") if "=" in item
+)
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("VERTEX_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("VERTEX_BREAKER_RESET_SECONDS", "30"))
+PROBE_INTERVAL_SECONDS = float(os.environ.get("VERTEX_PROBE_INTERVAL_SECONDS", "10"))
+# A probe that hasn't answered by then counts as a failure, so one hung region can't stall the prober
+PROBE_TIMEOUT_SECONDS = float(os.environ.get("VERTEX_PROBE_TIMEOUT_SECONDS", "5"))
+# Latency assumed for a region before we have measured it, so new regions still get traffic
+INITIAL_LATENCY_SECONDS = 1.0
+LATENCY_SMOOTHING = 0.2
+# Share of calls sent to a random healthy region so every region's latency stays measured
+EXPLORE_RATE = float(os.environ.get("VERTEX_EXPLORE_RATE", "0.05"))
+# Regions with less than this share of their quota left are only used when nothing else is
+QUOTA_HEADROOM = 0.1
+QUOTA_WINDOW_SECONDS = 60.0
+
+# Errors that say the region is in trouble, as opposed to the request being bad
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class NoHealthyRegion(Exception):
+    """Raised when every configured region is open-circuited or failed for this call."""
+
+
+def _started_stream(stream):
+    """Pulls the first chunk of a streamed response so connection errors surface while we can still fail over."""
+    iterator = iter(stream)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+
+    def chunks():
+        try:
+            yield first
+            yield from iterator
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    return chunks()
+
+
+def _record_failure(endpoint, error):
+    endpoint.breaker.record_failure()
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        endpoint.quota_exhausted()
+    metrics.increment(f"vertex_errors_{endpoint.region}")
+
+
+class HeldStream:
+    """A started stream that keeps its client slot and its region's in-flight count until it ends.
+
+    The call is settled once: on exhaustion or close() as a success, with the time to first chunk
+    as its latency, or on a regional error raised mid-stream as a breaker failure.
+    """
+
+    def __init__(self, endpoint, chunks, slot, first_chunk_seconds):
+        self.endpoint = endpoint
+        self._chunks = chunks
+        self._slot = slot
+        self._first_chunk_seconds = first_chunk_seconds
+        self._lock = threading.Lock()
+        self._settled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self._settle()
+            raise
+        except RETRYABLE_ERRORS as e:
+            self._settle(e)
+            raise
+        except Exception:
+            # As for unstreamed calls: the region answered, the request was the problem
+            self._settle()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._settle()
+
+    def _settle(self, error=None):
+        with self._lock:
+            if self._settled:
+                return
+            self._settled = True
+        self._slot.close()
+        if error is None:
+            self.endpoint.finish_call(self._first_chunk_seconds)
+            self.endpoint.breaker.record_success()
+            metrics.increment(f"vertex_calls_{self.endpoint.region}")
+        else:
+            self.endpoint.finish_call()
+            _record_failure(self.endpoint, error)
+            metrics.increment("vertex_stream_errors")
+
+    def __del__(self):
+        # An abandoned stream must still give its slot back
+        if not self._settled:
+            self.close()
+
+
+def vertex_model_factory(region, model_name, system_instruction):
+    """Builds a GenerativeModel pinned to one region through its full resource name."""
+    project = aiplatform_initializer.global_config.project
+    resource_name = f"projects/{project}/locations/{region}/publishers/google/models/{model_name}"
+    return GenerativeModel(model_name=resource_name, system_instruction=[system_instruction])
+
+
+class RegionalEndpoint:
+    """Per-region pools of model clients plus the health, latency and quota state used for routing."""
+
+    def __init__(self, region, model_factory, quota_rpm=None):
+        self.region = region
+        self.model_factory = model_factory
+        self.quota_rpm = quota_rpm
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        self.latency = INITIAL_LATENCY_SECONDS
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._models = {}
+        self._recent_calls = deque()
+        self._quota_blocked_until = 0.0
+
+    def clients(self, model_name, system_instruction):
+        key = (model_name, system_instruction)
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = ClientPool(
+                    lambda: self.model_factory(self.region, model_name, system_instruction),
+                    name=f"{self.region}_{model_name}",
+                )
+                # Enough model call threads for every client in every pool to be busy at once
+                deadline.reserve_model_workers(self._models[key].size)
+            return self._models[key]
+
+    def any_model(self):
+        with self._lock:
+            pools = list(self._models.values())
+        return next((client for client in (pool.any_client() for pool in pools) if client is not None), None)
+
+    def quota_remaining(self):
+        """Share of this region's per-minute quota still unused, between 0 and 1."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._quota_blocked_until:
+                return 0.0
+            while self._recent_calls and now - self._recent_calls[0] > QUOTA_WINDOW_SECONDS:
+                self._recent_calls.popleft()
+            if not self.quota_rpm:
+                return 1.0
+            return max(0.0, 1.0 - len(self._recent_calls) / self.quota_rpm)
+
+    def score(self):
+        """Expected cost of sending the next call here; lower is better."""
+        score = self.latency * (1 + self.in_flight)
+        if self.quota_remaining() < QUOTA_HEADROOM:
+            score *= 100
+        return score
+
+    def start_call(self):
+        with self._lock:
+            self.in_flight += 1
+            self._recent_calls.append(time.monotonic())
+
+    def finish_call(self, seconds=None):
+        with self._lock:
+            self.in_flight -= 1
+            if seconds is not None:
+                self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+        if seconds is not None:
+            metrics.set_gauge(f"vertex_latency_ewma_seconds_{self.region}", round(self.latency, 3))
+
+    def quota_exhausted(self):
+        with self._lock:
+            self._quota_blocked_until = time.monotonic() + QUOTA_WINDOW_SECONDS
+
+
+class RegionalModel:
+    """Drop-in stand-in for a GenerativeModel that spreads calls over the pool's regions."""
+
+    def __init__(self, pool, model_name, system_instruction):
+        self.pool = pool
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def generate_content(self, contents, **kwargs):
+        return self.pool.generate_content(self.model_name, self.system_instruction, contents, **kwargs)
+
+
+class EndpointPool:
+    """Routes model calls to the fastest healthy region with quota left and fails over on regional errors."""
+
+    def __init__(self, regions=None, model_factory=vertex_model_factory, quotas_rpm=None, probe_interval=PROBE_INTERVAL_SECONDS):
+        quotas_rpm = REGION_QUOTAS_RPM if quotas_rpm is None else quotas_rpm
+        self.endpoints = [RegionalEndpoint(region, model_factory, quotas_rpm.get(region)) for region in (regions or REGIONS)]
+        self.probe_interval = probe_interval
+        self._prober = None
+        self._prober_lock = threading.Lock()
+
+    def model(self, model_name, system_instruction):
+        return RegionalModel(self, model_name, system_instruction)
+
+    def candidates(self):
+        """Endpoints ordered best-first; open circuits are left out."""
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.breaker.state != OPEN]
+        ordered = sorted(healthy, key=lambda endpoint: endpoint.score())
+        if len(ordered) > 1 and random.random() < EXPLORE_RATE:
+            ordered.insert(0, ordered.pop(random.randrange(1, len(ordered))))
+        return ordered
+
+    def generate_content(self, model_name, system_instruction, contents, **kwargs):
+        self._ensure_prober()
+        last_error = None
+        for attempt, endpoint in enumerate(self.candidates()):
+            if not endpoint.breaker.allow_request():
+                continue
+            if attempt:
+                metrics.increment("vertex_failovers")
+            endpoint.start_call()
+            start = time.monotonic()
+            slot = ExitStack()
+            try:
+                client = slot.enter_context(endpoint.clients(model_name, system_instruction).acquire())
+                response = client.generate_content(contents, **kwargs)
+                if kwargs.get("stream"):
+                    response = _started_stream(response)
+            except RETRYABLE_ERRORS as e:
+                slot.close()
+                endpoint.finish_call()
+                _record_failure(endpoint, e)
+                last_error = e
+                continue
+            except Exception:
+                # The region answered; the request itself was bad, so don't fail over
+                slot.close()
+                endpoint.finish_call()
+                endpoint.breaker.record_success()
+                raise
+            if kwargs.get("stream"):
+                # The client stays checked out and the region busy until the caller has read the
+                # whole stream; latency for streamed calls is time to first chunk
+                return HeldStream(endpoint, response, slot, time.monotonic() - start)
+            slot.close()
+            endpoint.finish_call(time.monotonic() - start)
+            endpoint.breaker.record_success()
+            metrics.increment(f"vertex_calls_{endpoint.region}")
+            return response
+        raise NoHealthyRegion(f"No healthy Vertex region available for {model_name}") from last_error
+
+    def probe(self):
+        """Sends a cheap token-count call to each open region whose cool-down has passed."""
+        for endpoint in self.endpoints:
+            if endpoint.breaker.state != HALF_OPEN or not endpoint.breaker.allow_request():
+                continue
+            model = endpoint.any_model()
+            if model is None:
+                # Nothing has been called here yet, so there's nothing to probe with
+                endpoint.breaker.record_success()
+                continue
+            try:
+                deadline.Deadline(PROBE_TIMEOUT_SECONDS).call(model.count_tokens, "ping", stage="region probe")
+            except deadline.WorkersSaturated:
+                # Our threads are busy, which says nothing about the region; try again next round
+                endpoint.breaker.release()
+            except Exception:
+                endpoint.breaker.record_failure()
+                metrics.increment(f"vertex_probe_failures_{endpoint.region}")
+            else:
+                endpoint.breaker.record_success()
+                metrics.increment(f"vertex_probe_recoveries_{endpoint.region}")
+
+    def _ensure_prober(self):
+        if not self.probe_interval:
+            return
+        with self._prober_lock:
+            if self._prober is not None and self._prober.is_alive():
+                return
+            self._prober = threading.Thread(target=self._probe_loop, daemon=True)
+            self._prober.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            if any(endpoint.breaker.state != CLOSED for endpoint in self.endpoints):
+                self.probe()
+
+
+# Shared by every service module in the process
+pool = EndpointPool()
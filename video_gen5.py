@@ -1,16 +1,16 @@
 import base64
-import requests
-from io import BytesIO
-import PIL
-from PIL import Image
 import streamlit as st
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.generative_models import Part
+from deadline import Deadline
+import media_fetch
+import media_sniff
+import categorize
+import partial_fetch
+import preprocess_pool
 import vertexai.preview.generative_models as generative_models
-import cv2
 import numpy as np
 import os
-import tempfile
 
 # Initialize Vertex AI
 vertexai.init(project="travel-chatbot-409605", location="us-central1")
@@ -38,92 +38,58 @@ generation_config = {
     "top_p": 0.95,
 }
 
-model = GenerativeModel(model_name="gemini-1.5-flash-001", system_instruction=[system_instruction])
+model = categorize.regional_model(system_instruction)
 
 user_prompt=["identify the categories from the following content"]
 
-def fetch_and_preprocess_image(image_path):
+def fetch_and_preprocess_image(image_path, deadline=None):
     """Fetches the image from a local path or URL, converts it to a format suitable for the model, and returns a Part object."""
+    deadline = deadline or Deadline()
     if image_path.startswith("http://") or image_path.startswith("https://"):
-        response = requests.get(image_path)
-        image = Image.open(BytesIO(response.content))
+        source = partial_fetch.fetch_image(image_path, deadline)
     else:
-        image = Image.open(image_path)
+        source = image_path
 
-    image = image.resize((224, 224), PIL.Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    return Part.from_data(mime_type="image/jpeg", data=image_bytes)
+    mime_type, image_bytes = preprocess_pool.preprocess_image(source, deadline)
+    return Part.from_data(mime_type=mime_type, data=image_bytes)
 
-def fetch_and_preprocess_video(video_path):
+def fetch_and_preprocess_video(video_path, deadline=None):
     """Fetches the video from a local path or URL, extracts frames, and converts them to a format suitable for the model."""
+    deadline = deadline or Deadline()
     temp_file_path = None
-    supported_formats = ['.mp4', '.mov', '.avi', '.mkv', '.3gp', '.flv']
 
     try:
         if video_path.startswith("http://") or video_path.startswith("https://"):
-            response = requests.get(video_path, stream=True)
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mkv")
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
-            temp_file.close()
-            temp_file_path = temp_file.name
+            temp_file_path, _ = media_fetch.fetch_to_temp_file(video_path, deadline)
         else:
             temp_file_path = video_path
+            # Go by the content, not the name; downloads are sniffed the same way as they arrive
+            media = media_sniff.sniff_file(video_path)
+            if media is None or media.kind != media_sniff.VIDEO:
+                raise ValueError(f"Unsupported video format: {video_path}")
 
-        if not any(temp_file_path.endswith(ext) for ext in supported_formats):
-            raise ValueError(f"Unsupported video format: {video_path}")
-
-        cap = cv2.VideoCapture(temp_file_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {video_path}")
-
-        frames = []
-        success, frame = cap.read()
-        frame_interval = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / 5)
-
-        while success and len(frames) < 5:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(frame)
-            pil_image = pil_image.resize((224, 224), PIL.Image.Resampling.LANCZOS)
-            buffer = BytesIO()
-            pil_image.save(buffer, format="JPEG")
-            frames.append(Part.from_data(mime_type="image/jpeg", data=buffer.getvalue()))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_POS_FRAMES) + frame_interval)
-            success, frame = cap.read()
-
-        cap.release()
+        return categorize.extract_frames(temp_file_path, deadline, 5, video_path)
     finally:
         if temp_file_path and temp_file_path != video_path and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
 
-    return frames
-
 
 
 
-def predict_categories(caption, image_paths, video_paths):
+def predict_categories(caption, image_paths, video_paths, deadline=None):
     """Combines one caption with multiple images/videos into parts, calls the model, and returns the predicted categories."""
+    deadline = deadline or Deadline()
     contents = [Part.from_text(caption)]
-    unique_categories = set()
-
-    for image_path in image_paths:
-        image_part = fetch_and_preprocess_image(image_path)
-        content = contents + [image_part]
-        response = model.generate_content(content, generation_config=generation_config)
-        categories = response.text.strip().split(", ")
-        unique_categories.update(categories)
+    def media_categories():
+        for image_path in image_paths:
+            image_part = fetch_and_preprocess_image(image_path, deadline)
+            yield categorize.generate_categories(model, contents + [image_part], deadline, generation_config)
 
-    for video_path in video_paths:
-        video_frames = fetch_and_preprocess_video(video_path)
-        for frame in video_frames:
-            content = contents + [frame]
-            response = model.generate_content(content, generation_config=generation_config)
-            categories = response.text.strip().split(", ")
-            unique_categories.update(categories)
+        for video_path in video_paths:
+            for frame in fetch_and_preprocess_video(video_path, deadline):
+                yield categorize.generate_categories(model, contents + [frame], deadline, generation_config)
 
-    return list(unique_categories)
+    return categorize.collect(media_categories(), deadline)
 
 # Streamlit interface
 st.title("Image and Video Categorizer")
@@ -141,8 +107,10 @@ if st.button("Predict Categories"):
         st.error("Please enter a caption and at least one image or video URL.")
     else:
         try:
-            predicted_categories = predict_categories(caption_text, image_paths, video_paths)
+            predicted_categories, partial = predict_categories(caption_text, image_paths, video_paths, Deadline())
             st.success(f"Predicted Categories: {', '.join(predicted_categories)}")
+            if partial:
+                st.warning("Ran out of time before all media was processed; these categories are partial.")
         except Exception as e:
             st.error(f"An error occurred: {e}")
             st.error(str(e))